@@ -37,6 +37,10 @@ class KFXInput(InputFormatPlugin):
             help="Allow conversion to proceed even if the KFX book contains unexpected or incorrect data "
             "that may not convert properly. If this option is selected it is recommend that the log of each "
             "conversion be checked for error messages."),
+        OptionRecommendation(
+            name="validation_level", recommended_value="full", choices=["full", "fast", "off"],
+            help="Amount of checking done on the KFX book before conversion. 'full' reports all unexpected data, "
+            "'fast' only detects incomplete books, and 'off' skips all checks that are not needed for conversion."),
     }
 
     recommendations = EPUBInput.recommendations
@@ -99,7 +103,7 @@ class KFXInput(InputFormatPlugin):
             job_log.info("Converting %s" % name_of_file(stream))
 
             book = YJ_Book(stream, symbol_catalog_filename=get_symbol_catalog_filename())
-            book.decode_book(retain_yj_locals=True)
+            book.decode_book(retain_yj_locals=True, validation=getattr(options, "validation_level", "full"))
 
             if book.has_pdf_resource:
                 job_log.warning(
@@ -151,7 +155,7 @@ class KFXInput(InputFormatPlugin):
 
     def cli_main(self, argv):
         from calibre_plugins.kfx_input.config import config_split_landscape_comic_images
-        from calibre_plugins.kfx_input.kfxlib import (file_write_binary, set_logger, YJ_Book)
+        from calibre_plugins.kfx_input.kfxlib import (file_write_binary, set_logger, VALIDATION_LEVELS, YJ_Book)
 
         self.cli = True
         log = JobLog(Log())
@@ -173,6 +177,9 @@ class KFXInput(InputFormatPlugin):
         parser.add_argument("-u", "--unpack", action="store_true", help="Create a ZIP file with extracted resources")
         parser.add_argument("-j", "--json-content", action="store_true", help="Create a JSON content/position file")
         parser.add_argument("-c", "--cover", action="store_true", help="Create a generic EPUB cover page if the book does not already have one")
+        parser.add_argument("-v", "--validation", choices=VALIDATION_LEVELS, default="full",
+                            help="Amount of checking done on the book: full (default), fast (detect incomplete books only), "
+                            "or off")
         args = parser.parse_args(argv[1:])
 
         if os.path.isfile(args.infile):
@@ -192,12 +199,11 @@ class KFXInput(InputFormatPlugin):
 
         set_logger(log)
         book = YJ_Book(args.infile, symbol_catalog_filename=get_symbol_catalog_filename())
-        book.decode_book(retain_yj_locals=True)
+        book.decode_book(retain_yj_locals=True, validation=args.validation)
 
         if args.unpack:
-            zip_data = book.convert_to_zip_unpack()
             output_filename = self.get_output_filename(args, ".zip")
-            file_write_binary(output_filename, zip_data)
+            book.convert_to_zip_unpack(output_filename)
             log.info("KFX resources unpacked to %s" % output_filename)
 
         if args.json_content:
@@ -208,9 +214,9 @@ class KFXInput(InputFormatPlugin):
 
         if args.cbz:
             if book.is_image_based_fixed_layout:
-                cbz_data = book.convert_to_cbz(split_landscape_comic_images=config_split_landscape_comic_images())
                 output_filename = self.get_output_filename(args, ".cbz")
-                file_write_binary(output_filename, cbz_data)
+                book.convert_to_cbz(
+                    split_landscape_comic_images=config_split_landscape_comic_images(), output_filename=output_filename)
                 log.info("Converted book images to CBZ file %s" % output_filename)
             else:
                 log.error("Book format does not support CBZ conversion - must be image based fixed-layout")
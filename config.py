@@ -12,6 +12,7 @@ __copyright__ = "2017-2024, John Howell <jhowell@acm.org>"
 # Individual Setting names
 AllowImportFromKindles = "AllowImportFromKindles"
 SplitLandscapeComicImages = "SplitLandscapeComicImages"
+GatherByReference = "GatherByReference"
 
 # Set location where all preferences for this plugin will be stored
 plugin_config = JSONConfig("plugins/KFX Input")
@@ -19,6 +20,7 @@ plugin_config = JSONConfig("plugins/KFX Input")
 # Default values
 plugin_config.defaults[AllowImportFromKindles] = not tweaks.get("kfx_input_set_format_virtual", True)   # value used previously
 plugin_config.defaults[SplitLandscapeComicImages] = False
+plugin_config.defaults[GatherByReference] = False
 
 
 class ConfigWidget(QWidget):
@@ -51,6 +53,15 @@ class ConfigWidget(QWidget):
         layout.addWidget(self.SplitLandscapeComicImages)
         self.SplitLandscapeComicImages.setChecked(plugin_config[SplitLandscapeComicImages])
 
+        self.GatherByReference = QCheckBox("Reference Kindle for PC/Mac book files instead of copying them on import")
+        self.GatherByReference.setToolTip(
+            "Causes books imported from the Kindle for PC or Kindle for Mac application folders to be stored as a "
+            "small KFX-ZIP file that lists the original files instead of a copy of them. Conversion will fail if "
+            "the book is later removed or updated by the Kindle application. Books imported from Kindle devices "
+            "are always copied.")
+        layout.addWidget(self.GatherByReference)
+        self.GatherByReference.setChecked(plugin_config[GatherByReference])
+
         layout.addStretch()
         return group_box
 
@@ -58,6 +69,7 @@ class ConfigWidget(QWidget):
         # Called by calibre when the configuration dialog has been accepted
         plugin_config[AllowImportFromKindles] = self.AllowImportFromKindles.isChecked()
         plugin_config[SplitLandscapeComicImages] = self.SplitLandscapeComicImages.isChecked()
+        plugin_config[GatherByReference] = self.GatherByReference.isChecked()
 
 
 def config_allow_import_from_kindles():
@@ -66,3 +78,7 @@ def config_allow_import_from_kindles():
 
 def config_split_landscape_comic_images():
     return plugin_config[SplitLandscapeComicImages]
+
+
+def config_gather_by_reference():
+    return plugin_config[GatherByReference]
@@ -21,7 +21,8 @@ class GatherKFXZIPFileTypePlugin(FileTypePlugin):
 
     def run(self, path_to_ebook):
         from calibre.utils.logging import Log
-        from calibre_plugins.kfx_input.kfxlib import windows_long_path_fix
+        from calibre_plugins.kfx_input.config import config_gather_by_reference
+        from calibre_plugins.kfx_input.kfxlib import (create_kfx_manifest, KFX_MANIFEST_FILENAME, windows_long_path_fix)
 
         log = Log()
 
@@ -37,6 +38,7 @@ class GatherKFXZIPFileTypePlugin(FileTypePlugin):
             return path_to_ebook
 
         files = [path_to_ebook]
+        stable_location = False
 
         # original_path_to_file added in calibre 2.74.0 (Dec 8, 2016)
         orig_path, orig_fn = os.path.split(self.original_path_to_file)
@@ -61,6 +63,7 @@ class GatherKFXZIPFileTypePlugin(FileTypePlugin):
 
         elif orig_ext == ".azw" and re.match("^B[A-Z0-9]{9}_(EBOK|EBSP)$", orig_dir):
             # Kindle for PC and Kindle for Mac Classic
+            stable_location = True
             for dirpath, dns, fns in os.walk(orig_path):
                 for fn in fns:
                     if (os.path.splitext(fn)[1].lower() in [".md", ".res", ".voucher"] and
@@ -76,6 +79,7 @@ class GatherKFXZIPFileTypePlugin(FileTypePlugin):
 
         elif (orig_ext == ".azw8" or orig_fn == "BookManifest.kfx") and re.match("^[0-9a-f-]{36}$", orig_dir, flags=re.IGNORECASE):
             # Kindle for iOS and Mac (for possible future use, untested)
+            stable_location = True
             if orig_fn == "BookManifest.kfx":
                 files.pop(0)    # discard SQLite file with book bundle info
 
@@ -96,11 +100,22 @@ class GatherKFXZIPFileTypePlugin(FileTypePlugin):
 
         zfile = self.temporary_file(".kfx-zip")
 
-        with zipfile.ZipFile(zfile, "w", compression=zipfile.ZIP_STORED) as zf:
-            for filepath in files:
-                zf.write(windows_long_path_fix(filepath), os.path.basename(filepath))
+        manifest = None
+        if stable_location and config_gather_by_reference():
+            try:
+                manifest = create_kfx_manifest(files)
+            except Exception as e:
+                log.info("%s: Cannot reference original files, copying them instead (%s)" % (self.name, repr(e)))
 
-        log.info("%s: Gathered %d file(s) as %s" % (self.name, len(files), zfile.name))
+        with zipfile.ZipFile(zfile, "w", compression=zipfile.ZIP_STORED) as zf:
+            if manifest is not None:
+                zf.writestr(KFX_MANIFEST_FILENAME, manifest)
+            else:
+                for filepath in files:
+                    zf.write(windows_long_path_fix(filepath), os.path.basename(filepath))
+
+        log.info("%s: Gathered %d file(s) %sas %s" % (
+            self.name, len(files), "by reference " if manifest is not None else "", zfile.name))
         return zfile.name
 
     def is_customizable(self):
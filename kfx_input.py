@@ -23,7 +23,7 @@ class PluginWidget(Widget):
         self.db = db                # db is set for conversion, but not default preferences
         self.book_id = book_id      # book_id is set for individual conversion, but not bulk
 
-        Widget.__init__(self, parent, ["allow_conversion_with_errors"])
+        Widget.__init__(self, parent, ["allow_conversion_with_errors", "validation_level"])
         self.initialize_options(get_option, get_help, db, book_id)
 
     def setupUi(self, Form):
@@ -39,6 +39,11 @@ class PluginWidget(Widget):
         self.opt_allow_conversion_with_errors.setText("Allow conversion to complete even if errors are detected")
         self.formLayout.addRow(self.opt_allow_conversion_with_errors)
 
+        self.opt_validation_level = QtWidgets.QComboBox(Form)
+        self.opt_validation_level.setObjectName("opt_validation_level")
+        self.opt_validation_level.addItems(["full", "fast", "off"])
+        self.formLayout.addRow("Validation level:", self.opt_validation_level)
+
         self.formLayout.addItem(QtWidgets.QSpacerItem(20, 40, QtWidgets.QSizePolicy.Minimum, QtWidgets.QSizePolicy.Expanding))
 
         self.help_label = QtWidgets.QLabel(Form)
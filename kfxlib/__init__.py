@@ -14,6 +14,9 @@ __copyright__ = "2016-2024, John Howell <jhowell@acm.org>"
 
 set_logger = message_logging.set_logger
 YJ_Book = yj_book.YJ_Book
+VALIDATION_LEVELS = yj_book.VALIDATION_LEVELS
+KFX_MANIFEST_FILENAME = yj_book.KFX_MANIFEST_FILENAME
+create_kfx_manifest = yj_book.create_kfx_manifest
 YJ_Metadata = yj_metadata.YJ_Metadata
 KFXDRMError = utilities.KFXDRMError
 
@@ -739,17 +739,26 @@ class EPUB_Output(object):
                     data=html_str, mimetype="application/xhtml+xml")
 
     def consolidate_html(self, body):
+        attrib_keys = {}
+
+        def attrib_key(e):
+            key = attrib_keys.get(e)
+            if key is None:
+                key = attrib_keys[e] = tuple(sorted(e.attrib.items()))
+
+            return key
 
         for toptag in body.findall("*"):
-            changed = True
-            while changed:
-                changed = False
-                for e in toptag.iterdescendants():
-                    if e.tag in {"a", "b", "em", "i", "span", "strong", "sub", "sup", "u"}:
+            # merge each run of identical adjacent inline siblings before descending, so a single pass reaches a fixed point
+            parents = [toptag]
+            while parents:
+                parent = parents.pop()
+                e = parent[0] if len(parent) > 0 else None
+
+                while e is not None:
+                    if e.tag in CONSOLIDATED_INLINE_TAGS:
                         n = e.getnext()
-                        while ((not e.tail) and (n is not None) and n.tag == e.tag and
-                                tuple(sorted(dict(e.attrib).items())) == tuple(sorted(dict(n.attrib).items()))):
-
+                        while (not e.tail) and (n is not None) and n.tag == e.tag and attrib_key(n) == attrib_key(e):
                             if n.text:
                                 if len(e) > 0:
                                     tt = e[-1]
@@ -759,22 +768,22 @@ class EPUB_Output(object):
 
                                 n.text = ""
 
-                            while len(n) > 0:
-                                c = n[0]
-                                n.remove(c)
-                                e.append(c)
+                            e.extend(list(n))
 
                             if n.tail:
                                 e.tail = n.tail
 
                             n.getparent().remove(n)
-
-                            changed = True
+                            attrib_keys.pop(n, None)
 
                             n = e.getnext()
 
-                        if changed:
-                            break
+                    if len(e) > 0:
+                        parents.append(e)
+
+                    e = e.getnext()
+
+        attrib_keys.clear()
 
         TEMP_TAG = "temporary-tag"
         temp_tag_used = False
@@ -788,29 +797,31 @@ class EPUB_Output(object):
             etree.strip_tags(body, TEMP_TAG)
             temp_tag_used = False
 
-        while True:
-            for e in body.iter("div"):
-                if len(e.attrib) == 0:
-                    parent = e.getparent()
-                    if len(parent) == 1 and not parent.text:
-                        if parent.tag in {
-                                "aside", "caption", "div", "figure", "h1", "h2", "h3", "h4", "h5", "h6", "li", "p", "td",
-                                IDX_ENTRY}:
+        # visit elements in document order, revisiting the children of each stripped div in its place
+        pending = body.findall("*")
+        pending.reverse()
+
+        while pending:
+            e = pending.pop()
+            children = e.findall("*")
+
+            if e.tag == "div" and len(e.attrib) == 0:
+                parent = e.getparent()
+                if len(parent) == 1 and not parent.text:
+                    if parent.tag in STRIPPED_DIV_PARENT_TAGS:
+                        e.tag = TEMP_TAG
+                    elif parent.tag == "body" and not e.text:
+                        for child in children:
+                            if child.tag not in STRIPPED_DIV_BODY_CHILD_TAGS or child.tail:
+                                break
+                        else:
                             e.tag = TEMP_TAG
-                        elif parent.tag == "body" and not e.text:
-                            for child in e.iterfind("*"):
-                                if (child.tag not in {
-                                        "aside", "div", "figure", "h1", "h2", "h3", "h4", "h5", "h6", "hr", "iframe",
-                                        "ol", "p", "table", "ul", IDX_ENTRY} or child.tail):
-                                    break
-                            else:
-                                e.tag = TEMP_TAG
-
-                        if e.tag == TEMP_TAG:
-                            etree.strip_tags(parent, TEMP_TAG)
-                            break
-            else:
-                break
+
+                    if e.tag == TEMP_TAG:
+                        etree.strip_tags(parent, TEMP_TAG)
+
+            children.reverse()
+            pending.extend(children)
 
     def beautify_html(self, book_part):
         html = book_part.html
@@ -1481,3 +1492,8 @@ MATH = qname(MATHML_NS_URI, "math")
 SVG = qname(SVG_NS_URI, "svg")
 XLINK_HREF = qname(XLINK_NS_URI, "href")
 XML_LANG = qname(XML_NS_URI, "lang")
+
+CONSOLIDATED_INLINE_TAGS = {"a", "b", "em", "i", "span", "strong", "sub", "sup", "u"}
+STRIPPED_DIV_PARENT_TAGS = {"aside", "caption", "div", "figure", "h1", "h2", "h3", "h4", "h5", "h6", "li", "p", "td", IDX_ENTRY}
+STRIPPED_DIV_BODY_CHILD_TAGS = {
+    "aside", "div", "figure", "h1", "h2", "h3", "h4", "h5", "h6", "hr", "iframe", "ol", "p", "table", "ul", IDX_ENTRY}
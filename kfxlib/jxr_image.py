@@ -1,6 +1,7 @@
 from __future__ import (unicode_literals, division, absolute_import, print_function)
 
 import collections
+import itertools
 import math
 from PIL import Image
 
@@ -473,46 +474,34 @@ class JXRImage(object):
             raise Exception("Color format %s with %d components is not supported" % (
                     OUTPUT_COLOR_NAME[self.output_clr_fmt], self.primary_plane.NumComponents))
 
-        im = Image.new(mode, (self.image_width, self.image_height))
-        pixels = im.load()
+        if mode in ["RGBA", "RGB"]:
+            planes = self.primary_plane.ImagePlane[:3]
 
-        if mode == "RGBA":
-            r_data = self.primary_plane.ImagePlane[0]
-            g_data = self.primary_plane.ImagePlane[1]
-            b_data = self.primary_plane.ImagePlane[2]
-            a_data = self.primary_plane.ImagePlane[3] if self.output_clr_fmt == NCOMPONENT else self.alpha_plane.ImagePlane[0]
+            if mode == "RGBA":
+                planes.append(
+                    self.primary_plane.ImagePlane[3] if self.output_clr_fmt == NCOMPONENT else self.alpha_plane.ImagePlane[0])
 
-            for y in range(self.image_height):
-                for x in range(self.image_width):
-                    pixels[x, y] = (r_data[x][y], g_data[x][y], b_data[x][y], a_data[x][y]) if self.output_bitdepth == BD8 else \
-                        (r_data[x][y] >> 8, g_data[x][y] >> 8, b_data[x][y] >> 8, a_data[x][y] >> 8)
+            shift = 0 if self.output_bitdepth == BD8 else 8
+            return Image.merge(mode, [self.plane_image("L", plane, shift=shift) for plane in planes])
 
-        elif mode == "RGB":
-            r_data = self.primary_plane.ImagePlane[0]
-            g_data = self.primary_plane.ImagePlane[1]
-            b_data = self.primary_plane.ImagePlane[2]
+        y_data = self.primary_plane.ImagePlane[0]
 
-            for y in range(self.image_height):
-                for x in range(self.image_width):
-                    pixels[x, y] = (r_data[x][y], g_data[x][y], b_data[x][y]) if self.output_bitdepth == BD8 else \
-                        (r_data[x][y] >> 8, g_data[x][y] >> 8, b_data[x][y] >> 8)
+        if mode == "1":
+            return self.plane_image("L", y_data, scale=255).convert("1")
 
-        elif mode == "1":
-            y_data = self.primary_plane.ImagePlane[0]
+        return self.plane_image(mode, y_data)
 
-            for y in range(self.image_height):
-                for x in range(self.image_width):
-                    pixels[x, y] = y_data[x][y] * 255
+    def plane_image(self, mode, data, shift=0, scale=1):
+        values = itertools.chain.from_iterable(column[:self.image_height] for column in data[:self.image_width])
 
-        else:
-            y_data = self.primary_plane.ImagePlane[0]
-
-            for y in range(self.image_height):
-                for x in range(self.image_width):
-                    pixels[x, y] = y_data[x][y]
+        if shift:
+            values = (v >> shift for v in values)
+        elif scale != 1:
+            values = (v * scale for v in values)
 
-        del pixels
-        return im
+        im = Image.new(mode, (self.image_height, self.image_width))
+        im.putdata(list(values))
+        return im.transpose(Image.TRANSPOSE)
 
 
 class ImgPlane(object):
@@ -2,6 +2,7 @@ from __future__ import (unicode_literals, division, absolute_import, print_funct
 
 import io
 import os
+import shutil
 import sqlite3
 
 from .ion import (ion_type, IonAnnotation, IonBLOB, IonInt, IonList, IonSExp, IonString, IonStruct, IS)
@@ -9,9 +10,9 @@ from .ion_binary import (IonBinary)
 from .message_logging import log
 from .original_source_epub import SourceEpub
 from .utilities import (
-        DataFile, bytes_to_separated_hex, json_deserialize, json_serialize, KFXDRMError, temp_filename,
-        Deserializer, ZIP_SIGNATURE)
-from .yj_container import (CONTAINER_FORMAT_KPF, DRMION_SIGNATURE, YJContainer, YJFragment)
+        DataFile, bytes_to_separated_hex, file_read_binary, json_deserialize, json_serialize, KFXDRMError, temp_filename,
+        ZIP_SIGNATURE)
+from .yj_container import (CONTAINER_FORMAT_KPF, DRMION_SIGNATURE, RAW_FRAGMENT_TYPES, YJContainer, YJFragment)
 from .yj_symbol_catalog import SYSTEM_SYMBOL_TABLE
 
 from .yj_container import ROOT_FRAGMENT_TYPES
@@ -29,6 +30,14 @@ DICTIONARY_RULES_FILENAME = "DictionaryRules.ion"
 
 SQLITE_SIGNATURE = b"SQLite format 3\0"
 
+BOOTSTRAP_FRAGMENT_IDS = ("$ion_symbol_table", "max_id")
+
+KFXID_TRANSLATION_SCHEMA = "CREATE TABLE kfxid_translation(eid INTEGER, kfxid char(40), primary key(eid)) without rowid"
+FRAGMENT_PROPERTIES_SCHEMA = ("CREATE TABLE fragment_properties(id char(40), key char(40), value char(40), "
+                              "primary key (id, key, value)) without rowid")
+FRAGMENTS_SCHEMA = "CREATE TABLE fragments(id char(40), payload_type char(10), payload_value blob, primary key (id))"
+CAPABILITIES_SCHEMA = "CREATE TABLE capabilities(key char(20), version smallint, primary key (key, version)) without rowid"
+
 
 class KpfContainer(YJContainer):
     KPF_SIGNATURE = ZIP_SIGNATURE
@@ -38,6 +47,8 @@ class KpfContainer(YJContainer):
     def __init__(self, symtab, datafile=None, fragments=None, book=None):
         YJContainer.__init__(self, symtab, datafile=datafile, fragments=fragments)
         self.book = book
+        self.eid_symbol = {}
+        self.element_type = {}
 
     def deserialize(self, ignore_drm=False):
         self.ignore_drm = ignore_drm
@@ -52,7 +63,7 @@ class KpfContainer(YJContainer):
                 for info in zf.infolist():
                     ext = os.path.splitext(info.filename)[1]
                     if ext == ".kdf":
-                        self.kdf_datafile = DataFile(info.filename, zf.read(info), self.kpf_datafile)
+                        self.kdf_datafile = DataFile(info.filename, parent=self.kpf_datafile)
 
                     elif ext == ".kdf-journal":
                         if len(zf.read(info)) > 0:
@@ -68,10 +79,14 @@ class KpfContainer(YJContainer):
         else:
             self.kdf_datafile = self.datafile
 
-        unwrapped_kdf_datafile = SQLiteFingerprintWrapper(self.kdf_datafile).remove()
+        fingerprint_wrapper = SQLiteFingerprintWrapper(self.kdf_datafile)
 
-        db_filename = (unwrapped_kdf_datafile.name if unwrapped_kdf_datafile.is_real_file and not self.book.is_netfs else
-                       temp_filename("kdf", unwrapped_kdf_datafile.get_data()))
+        if self.kdf_datafile.is_real_file and not (self.book.is_netfs or fingerprint_wrapper.is_wrapped()):
+            db_filename = self.kdf_datafile.name
+        else:
+            db_filename = temp_filename("kdf")
+            with open(db_filename, "wb") as db_file:
+                fingerprint_wrapper.copy_unwrapped(db_file)
 
         if sqlite3.sqlite_version_info < (3, 8, 2):
             raise Exception(
@@ -84,15 +99,13 @@ class KpfContainer(YJContainer):
         sql_list = cursor.execute("SELECT sql FROM sqlite_master WHERE type='table';").fetchall()
         schema = set([x[0] for x in sql_list])
 
-        dictionary_index_terms = set()
-        first_head_word = ""
         INDEX_INFO_SCHEMA = ("CREATE TABLE index_info(namespace char(256), index_name char(256), property char(40), "
                              "primary key (namespace, index_name)) without rowid")
 
         if INDEX_INFO_SCHEMA in schema:
             schema.remove(INDEX_INFO_SCHEMA)
             self.book.is_dictionary = True
-            for namespace, index_name, property in cursor.execute("SELECT * FROM index_info;"):
+            for namespace, index_name, property in cursor.execute("SELECT * FROM index_info;").fetchall():
                 if namespace != "dictionary" or property != "yj.dictionary.term":
                     log.error("unexpected index_info: namespace=%s, index_name=%s, property=%s" % (namespace, index_name, property))
 
@@ -102,35 +115,23 @@ class KpfContainer(YJContainer):
 
                 if index_schema in schema:
                     schema.remove(index_schema)
-                    num_entries = 0
-                    index_words = set()
-                    index_kfx_ids = set()
-
-                    for dictionary_term, kfx_id in cursor.execute("SELECT * FROM %s;" % table_name):
-                        num_entries += 1
-                        dictionary_index_terms.add((dictionary_term, IS(kfx_id)))
-                        index_words.add(dictionary_term)
-                        index_kfx_ids.add(kfx_id)
-
-                        if dictionary_term < first_head_word or not first_head_word:
-                            first_head_word = dictionary_term
+                    num_entries, num_words, num_kfx_ids = cursor.execute(
+                            "SELECT COUNT(*), COUNT(DISTINCT [%s]), COUNT(DISTINCT id) FROM %s;" % (
+                                property, table_name)).fetchone()
 
                     log.info("Dictionary %s table has %d entries with %d terms and %d definitions" % (
-                            table_name, num_entries, len(index_words), len(index_kfx_ids)))
+                            table_name, num_entries, num_words, num_kfx_ids))
 
                 else:
                     log.error("KPF database is missing the '%s' table" % table_name)
 
         self.eid_symbol = {}
-        KFXID_TRANSLATION_SCHEMA = "CREATE TABLE kfxid_translation(eid INTEGER, kfxid char(40), primary key(eid)) without rowid"
         if KFXID_TRANSLATION_SCHEMA in schema:
             schema.remove(KFXID_TRANSLATION_SCHEMA)
             for eid, kfx_id in cursor.execute("SELECT * FROM kfxid_translation;"):
                 self.eid_symbol[eid] = self.create_local_symbol(kfx_id)
 
         self.element_type = {}
-        FRAGMENT_PROPERTIES_SCHEMA = ("CREATE TABLE fragment_properties(id char(40), key char(40), value char(40), "
-                                      "primary key (id, key, value)) without rowid")
         if FRAGMENT_PROPERTIES_SCHEMA in schema:
             schema.remove(FRAGMENT_PROPERTIES_SCHEMA)
             for id, key, value in cursor.execute("SELECT * FROM fragment_properties;"):
@@ -162,21 +163,34 @@ class KpfContainer(YJContainer):
             schema.remove(DELTA_FRAGMENTS_SCHEMA)
             self.book.is_scribe_notebook = True
 
-        FRAGMENTS_SCHEMA = "CREATE TABLE fragments(id char(40), payload_type char(10), payload_value blob, primary key (id))"
         if FRAGMENTS_SCHEMA in schema:
             schema.remove(FRAGMENTS_SCHEMA)
 
-            for condition in [" WHERE id = '$ion_symbol_table'", " WHERE id = 'max_id'", ""]:
-                delta_fragments = {}
+            for id in BOOTSTRAP_FRAGMENT_IDS:
+                row = None
                 if has_delta_fragments:
-                    for id, payload_type, payload_value, deleted in cursor.execute("SELECT * FROM local_delta_fragments%s;" % condition):
-                        delta_fragments[id] = (payload_type, payload_value)
-                        if not deleted:
-                            self.process_db_fragment(id, payload_type, payload_value)
-
-                for id, payload_type, payload_value in cursor.execute("SELECT * FROM fragments%s;" % condition):
-                    if id not in delta_fragments:
+                    row = cursor.execute("SELECT payload_type, payload_value, deleted FROM local_delta_fragments WHERE id = ?;",
+                                         (id,)).fetchone()
+
+                if row is None:
+                    row = cursor.execute("SELECT payload_type, payload_value, 0 FROM fragments WHERE id = ?;", (id,)).fetchone()
+
+                if row is not None and not row[2]:
+                    self.process_db_fragment(id, row[0], row[1])
+
+            delta_fragment_ids = set()
+            if has_delta_fragments:
+                for id, payload_type, payload_value, deleted in cursor.execute(
+                        "SELECT id, payload_type, payload_value, deleted FROM local_delta_fragments WHERE id NOT IN (?, ?);",
+                        BOOTSTRAP_FRAGMENT_IDS):
+                    delta_fragment_ids.add(id)
+                    if not deleted:
                         self.process_db_fragment(id, payload_type, payload_value)
+
+            for id, payload_type, payload_value in cursor.execute(
+                    "SELECT id, payload_type, payload_value FROM fragments WHERE id NOT IN (?, ?);", BOOTSTRAP_FRAGMENT_IDS):
+                if id not in delta_fragment_ids:
+                    self.process_db_fragment(id, payload_type, payload_value)
         else:
             log.error("KPF database is missing the 'fragments' table")
 
@@ -189,7 +203,6 @@ class KpfContainer(YJContainer):
         if GC_REACHABLE_SCHEMA in schema:
             schema.remove(GC_REACHABLE_SCHEMA)
 
-        CAPABILITIES_SCHEMA = "CREATE TABLE capabilities(key char(20), version smallint, primary key (key, version)) without rowid"
         if CAPABILITIES_SCHEMA in schema:
             schema.remove(CAPABILITIES_SCHEMA)
             capabilities = cursor.execute("SELECT * FROM capabilities;").fetchall()
@@ -234,6 +247,61 @@ class KpfContainer(YJContainer):
                     self.source_epub = SourceEpub(zip_file)
                     zip_file.close()
 
+    def serialize(self):
+        fragment_rows = []
+        fragment_properties = []
+        capabilities = []
+        ion_binary = IonBinary(self.symtab)
+
+        symbol_table_fragment = self.fragments.get("$ion_symbol_table")
+        symbol_table_import = self.symtab.create_import() if symbol_table_fragment is None else symbol_table_fragment
+        if symbol_table_import is not None:
+            fragment_rows.append(("$ion_symbol_table", "blob", ion_binary.serialize_single_value(
+                    IonAnnotation([IS("$ion_symbol_table")], symbol_table_import.value))))
+
+        for fragment in self.fragments:
+            if fragment.ftype in ["$270", "$ion_symbol_table"]:
+                continue
+
+            if fragment.ftype == "$593":
+                for fc in fragment.value:
+                    capabilities.append((fc["$492"], fc["version"]))
+
+                continue
+
+            id = str(fragment.fid)
+
+            if fragment.ftype in RAW_FRAGMENT_TYPES:
+                if fragment.ftype != "$417":
+                    log.error("KDF cannot store %s fragment %s" % (fragment.ftype, id))
+                    continue
+
+                payload_value = bytes(fragment.value)
+            else:
+                payload_value = ion_binary.serialize_single_value(IonAnnotation([IS(fragment.ftype)], fragment.value))
+
+            fragment_rows.append((id, "blob", payload_value))
+            fragment_properties.append((id, "element_type", self.element_type.get(id, fragment.ftype)))
+
+        db_filename = temp_filename("kdf")
+        conn = sqlite3.connect(db_filename, KpfContainer.db_timeout)
+        conn.execute("PRAGMA journal_mode = OFF;")
+        conn.execute("PRAGMA synchronous = OFF;")
+
+        with conn:
+            for schema in [KFXID_TRANSLATION_SCHEMA, FRAGMENT_PROPERTIES_SCHEMA, FRAGMENTS_SCHEMA, CAPABILITIES_SCHEMA]:
+                conn.execute(schema + ";")
+
+            conn.executemany("INSERT INTO kfxid_translation VALUES (?, ?);", sorted(
+                    (eid, str(symbol)) for eid, symbol in self.eid_symbol.items()))
+            conn.executemany("INSERT INTO fragment_properties VALUES (?, ?, ?);", fragment_properties)
+            conn.executemany("INSERT INTO fragments VALUES (?, ?, ?);", fragment_rows)
+            conn.executemany("INSERT INTO capabilities VALUES (?, ?);", capabilities)
+
+        conn.close()
+
+        return file_read_binary(db_filename)
+
     def process_db_fragment(self, id, payload_type, payload_value):
         ftype = id
         element_type = self.element_type.get(id)
@@ -322,7 +390,7 @@ class KpfContainer(YJContainer):
             log.error("Unexpected KDF payload_type=%s, id=%s, value=%d bytes" % (payload_type, id, len(payload_value)))
 
     def prep_payload_blob(self, data):
-        data = io.BytesIO(data).read()
+        data = bytes(data)
 
         if not data.startswith(DRMION_SIGNATURE):
             return data
@@ -380,11 +448,10 @@ class KpfContainer(YJContainer):
                 process(data.value)
 
             if data_type is IonList or data_type is IonSExp:
-                for i, val in enumerate(list(data)):
+                for i, val in enumerate(data):
                     new_val = process(val)
                     if new_val is not None:
-                        data.pop(i)
-                        data.insert(i, new_val)
+                        data[i] = new_val
 
             if data_type is IonStruct:
                 for key, val in data.items():
@@ -412,28 +479,47 @@ class SQLiteFingerprintWrapper(object):
     def __init__(self, datafile):
         self.datafile = datafile
 
-    def remove(self):
-        data = self.datafile.get_data()
-
-        if (len(data) < self.FINGERPRINT_OFFSET + self.FINGERPRINT_RECORD_LEN or
-                data[self.FINGERPRINT_OFFSET:self.FINGERPRINT_OFFSET + len(self.FINGERPRINT_SIGNATURE)] != self.FINGERPRINT_SIGNATURE):
-            return self.datafile
-
-        fingerprint_count = 0
-        data_offset = self.FINGERPRINT_OFFSET
+    def is_wrapped(self):
+        with self.datafile.open() as infile:
+            return self.has_fingerprint(infile.read(self.FINGERPRINT_OFFSET + self.FINGERPRINT_RECORD_LEN))
+
+    def has_fingerprint(self, header):
+        signature_end = self.FINGERPRINT_OFFSET + len(self.FINGERPRINT_SIGNATURE)
+        return (len(header) >= self.FINGERPRINT_OFFSET + self.FINGERPRINT_RECORD_LEN and
+                header[self.FINGERPRINT_OFFSET:signature_end] == self.FINGERPRINT_SIGNATURE)
+
+    def copy_unwrapped(self, outfile):
+        with self.datafile.open() as infile:
+            header = infile.read(self.FINGERPRINT_OFFSET + self.FINGERPRINT_RECORD_LEN)
+            if not self.has_fingerprint(header):
+                outfile.write(header)
+                shutil.copyfileobj(infile, outfile)
+                return
+
+            outfile.write(header[:self.FINGERPRINT_OFFSET])
+
+            fingerprint = header[self.FINGERPRINT_OFFSET:]
+            fingerprint_count = 0
+
+            while len(fingerprint) == self.FINGERPRINT_RECORD_LEN:
+                signature = fingerprint[:len(self.FINGERPRINT_SIGNATURE)]
+                if signature != self.FINGERPRINT_SIGNATURE:
+                    log.error("Unexpected fingerprint %d signature: %s" % (fingerprint_count, bytes_to_separated_hex(signature)))
+                    infile.seek(0)
+                    outfile.seek(0)
+                    outfile.truncate()
+                    shutil.copyfileobj(infile, outfile)
+                    return
 
-        while len(data) >= data_offset + self.FINGERPRINT_RECORD_LEN:
-            fingerprint = Deserializer(data[data_offset:data_offset + self.FINGERPRINT_RECORD_LEN])
+                fingerprint_count += 1
 
-            signature = fingerprint.extract(4)
-            if signature != self.FINGERPRINT_SIGNATURE:
-                log.error("Unexpected fingerprint %d signature: %s" % (fingerprint_count, bytes_to_separated_hex(signature)))
-                return self.datafile
+                data_records = infile.read(self.DATA_RECORD_LEN * self.DATA_RECORD_COUNT)
+                outfile.write(data_records)
+                if len(data_records) < self.DATA_RECORD_LEN * self.DATA_RECORD_COUNT:
+                    break
 
-            data = data[:data_offset] + data[data_offset + self.FINGERPRINT_RECORD_LEN:]
-            fingerprint_count += 1
-            data_offset += self.DATA_RECORD_LEN * self.DATA_RECORD_COUNT
+                fingerprint = infile.read(self.FINGERPRINT_RECORD_LEN)
+            else:
+                outfile.write(fingerprint)
 
         log.info("Removed %d KDF SQLite file fingerprint(s)" % fingerprint_count)
-
-        return DataFile(self.datafile.name + "-unwrapped", data)
@@ -1,16 +1,23 @@
 from __future__ import (unicode_literals, division, absolute_import, print_function)
 
 
+import collections
+import hashlib
 import io
 import os
-from PIL import Image
+from PIL import (Image, JpegImagePlugin)
+import re
+import shutil
+import struct
+import subprocess
+import threading
 import time
 
 from .jxr_container import JXRContainer
 from .message_logging import log
 from .utilities import (
-    add_plugin_path, calibre_numeric_version, create_temp_dir, disable_debug_log, natural_sort_key,
-    remove_plugin_path, temp_filename)
+    add_plugin_path, calibre_numeric_version, create_temp_dir, disable_debug_log, file_read_binary, file_write_binary,
+    natural_sort_key, remove_plugin_path, temp_filename)
 
 if calibre_numeric_version is not None:
     add_plugin_path()
@@ -26,12 +33,27 @@ __copyright__ = "2016-2024, John Howell <jhowell@acm.org>"
 COMBINE_TILES_LOSSLESS = True
 MIN_JPEG_QUALITY = 90
 MAX_JPEG_QUALITY = 100
+JPEG_QUALITY_SAMPLE_BAND_HEIGHT = 16
+JPEG_QUALITY_SAMPLE_INTERVAL = 8
+MIN_JPEG_QUALITY_SAMPLE_BANDS = 4
+MAX_JPEG_QUALITY_ENCODES = 2
+MAX_LOSSLESS_SPLIT_SHIFT = 4
+MAX_CACHED_PDF_READERS = 4
 COMBINED_TILE_SIZE_FACTOR = 1.2
 TILE_SIZE_REPORT_PERCENTAGE = 10
 DEBUG_TILES = False
 
+MIN_PDF_PAGES_PER_SHARD = 8
+
 CONVERT_JXR_LOSSLESS = False
 
+MAX_TRANSCODE_CACHE_MEMORY = 64 * 1024 * 1024
+TRANSCODE_CACHE_DIRECTORY = None
+MAX_TRANSCODE_CACHE_DISK = 512 * 1024 * 1024
+MAX_CACHED_DIGESTS = 16
+DIGEST_SAMPLE_SIZE = 4096
+TRANSCODE_CACHE_VERSION = 1
+
 IMAGE_COLOR_MODES = [
     "1",
     "L",
@@ -245,46 +267,252 @@ class PdfImageResource(ImageResource):
         return self.page_nums == list(range(1, self.total_pages + 1))
 
     def page_number_ranges(self):
-        ranges = []
-        start = end = None
-
-        for page_num in self.page_nums:
-            if start is None:
-                start = end = page_num
-            elif page_num == end + 1:
-                end = page_num
-            else:
-                ranges.append((start, end + 1))
-                start = end = page_num
+        return page_number_ranges(self.page_nums)
+
 
-        if start is not None:
+def page_number_ranges(page_nums):
+    ranges = []
+    start = end = None
+
+    for page_num in page_nums:
+        if start is None:
+            start = end = page_num
+        elif page_num == end + 1:
+            end = page_num
+        else:
             ranges.append((start, end + 1))
+            start = end = page_num
+
+    if start is not None:
+        ranges.append((start, end + 1))
+
+    return ranges
+
+
+class TranscodeCache(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.memory_size = 0
+        self.disk_size = None
+        self.digests = collections.OrderedDict()
+        self.hits = self.disk_hits = self.misses = 0
+
+    def key(self, data, operation):
+        return self.digest_key(self.digest(data), operation)
+
+    def digest_key(self, digest, operation):
+        return "%s-%d-%s" % (digest, TRANSCODE_CACHE_VERSION, operation)
+
+    def digest(self, data):
+        # digests are remembered by object identity. Small inputs are pinned, counting against the memory limit, while
+        # large inputs are only recognized by their length and a sample of their content.
+        pinned = data if len(data) <= MAX_TRANSCODE_CACHE_MEMORY // 2 else None
+        sample = None if pinned is not None else (len(data), data[:DIGEST_SAMPLE_SIZE], data[-DIGEST_SAMPLE_SIZE:])
+
+        with self.lock:
+            cache_entry = self.digests.pop(id(data), None)
+            if cache_entry is not None:
+                self.memory_size -= len(cache_entry[0] or b"")
+                if cache_entry[0] is not pinned or cache_entry[1] != sample:
+                    cache_entry = None
+
+        if cache_entry is None:
+            cache_entry = (pinned, sample, hashlib.sha256(data).hexdigest())
+
+        with self.lock:
+            old_entry = self.digests.pop(id(data), None)
+            if old_entry is not None:
+                self.memory_size -= len(old_entry[0] or b"")
+
+            self.digests[id(data)] = cache_entry
+            self.memory_size += len(pinned or b"")
+
+            while len(self.digests) > MAX_CACHED_DIGESTS:
+                self.memory_size -= len(self.digests.popitem(last=False)[1][0] or b"")
+
+            self.trim()
+
+        return cache_entry[2]
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+                self.hits += 1
+                return value
+
+        filename = self.disk_filename(key)
+        if filename is not None and os.path.isfile(filename):
+            try:
+                value = file_read_binary(filename)
+                os.utime(filename, None)
+            except Exception:
+                value = None
+
+            if value is not None:
+                with self.lock:
+                    self.disk_hits += 1
+
+                self.put(key, value, write_disk=False)
+                return value
+
+        with self.lock:
+            self.misses += 1
+
+        return None
+
+    def put(self, key, value, write_disk=True):
+        with self.lock:
+            if key not in self.entries and len(value) <= MAX_TRANSCODE_CACHE_MEMORY:
+                self.entries[key] = value
+                self.memory_size += len(value)
+                self.trim()
+
+        filename = self.disk_filename(key) if write_disk else None
+        if filename is not None:
+            try:
+                self.write_disk(filename, value)
+            except Exception as e:
+                log.warning("Failed to write transcoding cache file %s: %s" % (filename, repr(e)))
+
+    def trim(self):
+        while self.memory_size > MAX_TRANSCODE_CACHE_MEMORY:
+            if self.digests:
+                self.memory_size -= len(self.digests.popitem(last=False)[1][0] or b"")
+            else:
+                self.memory_size -= len(self.entries.popitem(last=False)[1])
 
-        return ranges
+    def disk_filename(self, key):
+        if not TRANSCODE_CACHE_DIRECTORY:
+            return None
+
+        return os.path.join(TRANSCODE_CACHE_DIRECTORY, hashlib.sha256(key.encode("ascii")).hexdigest() + ".bin")
+
+    def write_disk(self, filename, value):
+        if not os.path.isdir(TRANSCODE_CACHE_DIRECTORY):
+            os.makedirs(TRANSCODE_CACHE_DIRECTORY)
+
+        temp_name = "%s.%d.tmp" % (filename, os.getpid())
+        file_write_binary(temp_name, value)
+        os.replace(temp_name, filename)
+
+        with self.lock:
+            if self.disk_size is None:
+                cache_files = self.disk_files()
+                self.disk_size = sum(size for mtime, size, name in cache_files)
+            else:
+                cache_files = None
+                self.disk_size += len(value)
+
+            if self.disk_size > MAX_TRANSCODE_CACHE_DISK:
+                for mtime, size, name in sorted(cache_files or self.disk_files()):
+                    if self.disk_size <= MAX_TRANSCODE_CACHE_DISK * 0.9:
+                        break
+
+                    try:
+                        os.remove(name)
+                    except Exception:
+                        pass
+                    else:
+                        self.disk_size -= size
+
+    def disk_files(self):
+        cache_files = []
+        for entry in os.scandir(TRANSCODE_CACHE_DIRECTORY):
+            if entry.name.endswith(".bin") and entry.is_file():
+                stat = entry.stat()
+                cache_files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        return cache_files
+
+    def report(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            if lookups:
+                log.info("Transcoding cache: %d of %d lookups hit (%d%%), %d from disk" % (
+                    self.hits + self.disk_hits, lookups, ((self.hits + self.disk_hits) * 100) // lookups, self.disk_hits))
+
+            self.hits = self.disk_hits = self.misses = 0
+
+            for pinned, sample, digest in self.digests.values():
+                self.memory_size -= len(pinned or b"")
+
+            self.digests.clear()
+
+
+transcode_cache = TranscodeCache()
+
+
+def report_transcode_cache():
+    transcode_cache.report()
 
 
 def convert_jxr_to_jpeg_or_png(jxr_data, resource_name, return_mime=False):
-    try:
-        image_data = convert_jxr_to_tiff(jxr_data, resource_name)
-    except Exception as e:
-        log.error("Exception during conversion of JPEG-XR '%s' to TIFF: %s" % (resource_name, repr(e)))
-        image_data = jxr_data
-        image_type = "$548"
-    else:
-        with disable_debug_log():
-            img = Image.open(io.BytesIO(image_data))
-            image_type, ofmt, optimize = ("$284", "PNG", False) if CONVERT_JXR_LOSSLESS or img.mode == "RGBA" else ("$285", "JPEG", True)
-            outfile = io.BytesIO()
-            img.save(outfile, ofmt, quality=95, optimize=optimize)
-            img.close()
+    cache_key = transcode_cache.key(jxr_data, "jxr-jpeg-png-%s" % CONVERT_JXR_LOSSLESS)
+    image_data = transcode_cache.get(cache_key)
 
-        image_data = outfile.getvalue()
-        outfile.close()
+    if image_data is not None:
+        image_type = "$284" if image_file_ext(image_data) == ".png" else "$285"
+    else:
+        try:
+            image_data, image_type = jxr_to_jpeg_or_png(jxr_data, resource_name)
+        except Exception as e:
+            log.error("Exception during conversion of JPEG-XR '%s': %s" % (resource_name, repr(e)))
+            image_data = jxr_data
+            image_type = "$548"
+        else:
+            transcode_cache.put(cache_key, image_data)
 
     return image_data, MIMETYPE_OF_EXT["." + SYMBOL_FORMATS[image_type]] if return_mime else image_type
 
 
 def convert_jxr_to_tiff(jxr_data, resource_name):
+    cache_key = transcode_cache.key(jxr_data, "jxr-tiff")
+    tiff_data = transcode_cache.get(cache_key)
+
+    if tiff_data is None:
+        tiff_data = jxr_to_tiff(jxr_data, resource_name)
+        transcode_cache.put(cache_key, tiff_data)
+
+    return tiff_data
+
+
+def jxr_to_jpeg_or_png(jxr_data, resource_name):
+
+    if calibre_numeric_version is not None:
+
+        try:
+            from calibre.utils.img import (load_jxr_data, image_to_data)
+            img = load_jxr_data(jxr_data)
+            image_type, ofmt = ("$284", "PNG") if CONVERT_JXR_LOSSLESS or img.hasAlphaChannel() else ("$285", "JPEG")
+            image_data = image_to_data(img, compression_quality=95, fmt=ofmt)
+
+            if image_data:
+                return image_data, image_type
+        except Exception as e:
+            log.warning("Conversion of JPEG-XR resource failed: %s" % repr(e))
+
+        log.info("Using fallback JPEG-XR conversion for %s" % resource_name)
+
+    im = decode_jxr_image(jxr_data)
+
+    with disable_debug_log():
+        if CONVERT_JXR_LOSSLESS or im.mode == "RGBA":
+            image_type, ofmt, optimize = ("$284", "PNG", False)
+        else:
+            image_type, ofmt, optimize = ("$285", "JPEG", True)
+
+        outfile = io.BytesIO()
+        im.save(outfile, ofmt, quality=95, optimize=optimize)
+        im.close()
+        del im
+
+    return outfile.getvalue(), image_type
+
+
+def jxr_to_tiff(jxr_data, resource_name):
 
     if calibre_numeric_version is not None:
 
@@ -300,13 +528,7 @@ def convert_jxr_to_tiff(jxr_data, resource_name):
 
         log.info("Using fallback JPEG-XR conversion for %s" % resource_name)
 
-    start_time = time.time()
-
-    im = JXRContainer(jxr_data).unpack_image()
-
-    duration = time.time() - start_time
-    if duration >= 5.0:
-        log.info("JPEG-XR to TIFF conversion took %0.1f sec" % duration)
+    im = decode_jxr_image(jxr_data)
 
     outfile = io.BytesIO()
     with disable_debug_log():
@@ -317,33 +539,114 @@ def convert_jxr_to_tiff(jxr_data, resource_name):
     return outfile.getvalue()
 
 
+def decode_jxr_image(jxr_data):
+    start_time = time.time()
+
+    im = JXRContainer(jxr_data).unpack_image()
+
+    duration = time.time() - start_time
+    if duration >= 5.0:
+        log.info("JPEG-XR decoding took %0.1f sec" % duration)
+
+    return im
+
+
 def convert_pdf_to_jpeg(pdf_data, page_num, dpi=150, reported_errors=None):
+    for page_num, jpeg_data in convert_pdf_pages_to_jpeg(pdf_data, [page_num], dpi=dpi, workers=1):
+        return jpeg_data
+
+
+def convert_pdf_pages_to_jpeg(pdf_data, page_nums, dpi=150, workers=None):
+    pdf_digest = transcode_cache.digest(pdf_data)
+    cache_keys = dict((page_num, transcode_cache.digest_key(pdf_digest, "pdf-jpeg-%d-%d" % (page_num, dpi))) for page_num in page_nums)
+    cached_pages = {}
+    for page_num in page_nums:
+        jpeg_data = transcode_cache.get(cache_keys[page_num])
+        if jpeg_data is not None:
+            cached_pages[page_num] = jpeg_data
+
+    missing_page_nums = [page_num for page_num in page_nums if page_num not in cached_pages]
+    rendered_pages = render_pdf_pages(pdf_data, missing_page_nums, dpi, workers)
+
+    for page_num in page_nums:
+        if page_num in cached_pages:
+            yield (page_num, cached_pages[page_num])
+        else:
+            rendered_page_num, jpeg_data = next(rendered_pages)
+            transcode_cache.put(cache_keys[rendered_page_num], jpeg_data)
+            yield (rendered_page_num, jpeg_data)
+
+
+def render_pdf_pages(pdf_data, page_nums, dpi, workers):
+    if not page_nums:
+        return
+
+    pdftoppm = pdftoppm_path()
     pdf_file = temp_filename("pdf", pdf_data)
-    jpeg_dir = create_temp_dir()
 
-    if calibre_numeric_version is not None:
+    shards = []
+    workers = max(1, workers or os.cpu_count() or 1)
+    shard_size = max(MIN_PDF_PAGES_PER_SHARD, -(-len(page_nums) // workers))
+    for start, stop in page_number_ranges(page_nums):
+        for first in range(start, stop, shard_size):
+            shards.append((first, min(first + shard_size, stop) - 1))
 
-        if dpi != 150:
-            raise Exception("calibre PDF page_images supports only default 150dpi")
+    running = []
+    try:
+        for first, last in shards:
+            running.append(start_pdf_page_render(pdftoppm, pdf_file, first, last, dpi))
 
-        from calibre.ebooks.metadata.pdf import page_images
-        page_images(pdf_file, jpeg_dir, first=page_num, last=page_num)
+            if len(running) >= workers:
+                for page in finish_pdf_page_render(*running.pop(0)):
+                    yield page
 
-    for dirpath, dirnames, filenames in os.walk(jpeg_dir):
-        if len(filenames) != 1:
-            raise Exception("pdftoppm created %d files" % len(filenames))
+        while running:
+            for page in finish_pdf_page_render(*running.pop(0)):
+                yield page
+    finally:
+        for process, jpeg_dir, first, last in running:
+            process.kill()
+            process.wait()
 
-        if not (filenames[0].endswith(".jpg") or filenames[0].endswith(".jpeg")):
-            raise Exception("pdftoppm created unexpected file: %s" % filenames[0])
 
-        with io.open(os.path.join(dirpath, filenames[0]), "rb") as of:
-            jpeg_data = of.read()
+def pdftoppm_path():
+    if calibre_numeric_version is None:
+        raise Exception("PDF page rendering requires calibre")
+
+    from calibre.ebooks.metadata.pdf import get_tools
+    return get_tools()[1]
 
-        break
-    else:
-        raise Exception("pdftoppm created no files")
 
-    return jpeg_data
+def start_pdf_page_render(pdftoppm, pdf_file, first, last, dpi):
+    jpeg_dir = create_temp_dir()
+    process = subprocess.Popen(
+        [pdftoppm, "-cropbox", "-jpeg", "-r", str(dpi), "-f", str(first), "-l", str(last),
+            pdf_file, os.path.join(jpeg_dir, "page")],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0))
+    return (process, jpeg_dir, first, last)
+
+
+def finish_pdf_page_render(process, jpeg_dir, first, last):
+    returncode = process.wait()
+    if returncode != 0:
+        raise Exception("pdftoppm failed for pages %d-%d (error code %d)" % (first, last, returncode))
+
+    pages = {}
+    for filename in os.listdir(jpeg_dir):
+        m = re.match(r"^page-([0-9]+)\.jpe?g$", filename)
+        if m is None:
+            raise Exception("pdftoppm created unexpected file: %s" % filename)
+
+        with io.open(os.path.join(jpeg_dir, filename), "rb") as of:
+            pages[int(m.group(1))] = of.read()
+
+        os.remove(os.path.join(jpeg_dir, filename))
+
+    for page_num in range(first, last + 1):
+        if page_num not in pages:
+            raise Exception("pdftoppm did not create page %d" % page_num)
+
+        yield (page_num, pages.pop(page_num))
 
 
 def convert_image_to_pdf(image_resource):
@@ -371,6 +674,129 @@ def convert_image_to_pdf(image_resource):
     return PdfImageResource(image_resource.location, pdf_data, 0, 1)
 
 
+def add_image_to_pdf(pdf_writer, image_resource):
+    if image_resource.format == "$285":
+        pdf_image = jpeg_pdf_image(image_resource.raw_media)
+    elif image_resource.format == "$284":
+        pdf_image = png_pdf_image(image_resource.raw_media)
+    else:
+        pdf_image = None
+
+    add_object = pdf_object_adder(pdf_writer)
+    if pdf_image is None or add_object is None:
+        return False
+
+    width = pdf_image[pypdf.generic.NameObject("/Width")]
+    height = pdf_image[pypdf.generic.NameObject("/Height")]
+
+    contents = pypdf.generic.StreamObject()
+    contents.set_data(("q %d 0 0 %d 0 0 cm /Im0 Do Q" % (width, height)).encode("ascii"))
+
+    page = pdf_writer.add_blank_page(width, height)
+    page[pypdf.generic.NameObject("/Resources")] = pypdf.generic.DictionaryObject({
+        pypdf.generic.NameObject("/XObject"): pypdf.generic.DictionaryObject({
+            pypdf.generic.NameObject("/Im0"): add_object(pdf_image)})})
+    page[pypdf.generic.NameObject("/Contents")] = add_object(contents)
+    return True
+
+
+def pdf_object_adder(pdf_writer):
+    # pypdf has no public method to add an indirect object, which PDF requires for streams. PdfWriter._add_object is
+    # present from pypdf 3 through at least 6.20. If it disappears the caller falls back to converting images via Pillow.
+    add_object = getattr(pdf_writer, "_add_object", None)
+    return add_object if callable(add_object) else None
+
+
+def jpeg_pdf_image(raw_media):
+    with disable_debug_log():
+        try:
+            img = Image.open(io.BytesIO(raw_media))
+        except Exception:
+            return None
+
+        width, height = img.size
+        mode = img.format, img.mode
+        img.close()
+
+    color_space = {("JPEG", "L"): "/DeviceGray", ("JPEG", "RGB"): "/DeviceRGB", ("JPEG", "CMYK"): "/DeviceCMYK"}.get(mode)
+    if color_space is None:
+        return None
+
+    pdf_image = pdf_image_stream(width, height, pypdf.generic.NameObject(color_space), 8, "/DCTDecode", raw_media)
+
+    if color_space == "/DeviceCMYK":
+        pdf_image[pypdf.generic.NameObject("/Decode")] = pypdf.generic.ArrayObject(
+            [pypdf.generic.NumberObject(n) for n in [1, 0, 1, 0, 1, 0, 1, 0]])
+
+    return pdf_image
+
+
+def png_pdf_image(raw_media):
+    if not raw_media.startswith(b"\x89PNG\x0d\x0a\x1a\x0a"):
+        return None
+
+    header = palette = None
+    image_data = []
+    pos = 8
+    while pos + 8 <= len(raw_media):
+        length, chunk_type = struct.unpack_from(">L4s", raw_media, pos)
+        chunk = raw_media[pos + 8:pos + 8 + length]
+        pos += length + 12
+
+        if chunk_type == b"IHDR":
+            header = struct.unpack(">LLBBBBB", chunk)
+        elif chunk_type == b"PLTE":
+            palette = chunk
+        elif chunk_type == b"IDAT":
+            image_data.append(chunk)
+        elif chunk_type == b"tRNS":
+            return None
+        elif chunk_type == b"IEND":
+            break
+
+    if header is None or not image_data:
+        return None
+
+    width, height, bit_depth, color_type, compression, filter_method, interlace = header
+
+    if compression != 0 or filter_method != 0 or interlace != 0:
+        return None
+
+    if color_type == 0 and bit_depth in {1, 2, 4, 8}:
+        colors, color_space = 1, pypdf.generic.NameObject("/DeviceGray")
+    elif color_type == 2 and bit_depth == 8:
+        colors, color_space = 3, pypdf.generic.NameObject("/DeviceRGB")
+    elif color_type == 3 and bit_depth in {1, 2, 4, 8} and palette:
+        colors, color_space = 1, pypdf.generic.ArrayObject([
+            pypdf.generic.NameObject("/Indexed"), pypdf.generic.NameObject("/DeviceRGB"),
+            pypdf.generic.NumberObject(len(palette) // 3 - 1), pypdf.generic.ByteStringObject(palette)])
+    else:
+        return None
+
+    pdf_image = pdf_image_stream(width, height, color_space, bit_depth, "/FlateDecode", b"".join(image_data))
+    pdf_image[pypdf.generic.NameObject("/DecodeParms")] = pypdf.generic.DictionaryObject({
+        pypdf.generic.NameObject("/Predictor"): pypdf.generic.NumberObject(15),
+        pypdf.generic.NameObject("/Colors"): pypdf.generic.NumberObject(colors),
+        pypdf.generic.NameObject("/BitsPerComponent"): pypdf.generic.NumberObject(bit_depth),
+        pypdf.generic.NameObject("/Columns"): pypdf.generic.NumberObject(width)})
+    return pdf_image
+
+
+def pdf_image_stream(width, height, color_space, bits_per_component, filter_name, data):
+    pdf_image = pypdf.generic.StreamObject()
+    pdf_image.update({
+        pypdf.generic.NameObject("/Type"): pypdf.generic.NameObject("/XObject"),
+        pypdf.generic.NameObject("/Subtype"): pypdf.generic.NameObject("/Image"),
+        pypdf.generic.NameObject("/Width"): pypdf.generic.NumberObject(width),
+        pypdf.generic.NameObject("/Height"): pypdf.generic.NumberObject(height),
+        pypdf.generic.NameObject("/ColorSpace"): color_space,
+        pypdf.generic.NameObject("/BitsPerComponent"): pypdf.generic.NumberObject(bits_per_component),
+        pypdf.generic.NameObject("/Filter"): pypdf.generic.NameObject(filter_name),
+        })
+    pdf_image.set_data(bytes(data))
+    return pdf_image
+
+
 def combine_image_tiles(
         resource_name, resource_height, resource_width, resource_format, tile_height, tile_width, tile_padding,
         yj_tiles, tiles_raw_media, ignore_variants):
@@ -381,7 +807,6 @@ def combine_image_tiles(
         log.warning("tiled image %dx%d: %s" % (nrows, ncols, resource_name))
 
     with disable_debug_log():
-        tile_images = []
         separate_tiles_size = tile_count = 0
         full_image_color_mode = IMAGE_COLOR_MODES[0]
         full_image_opacity_mode = ""
@@ -394,23 +819,25 @@ def combine_image_tiles(
                 if tile_raw_media is not None:
                     tile_count += 1
                     separate_tiles_size += len(tile_raw_media)
+
+                    # only the image header is read here, tiles are decoded one at a time below
                     tile = Image.open(io.BytesIO(tile_raw_media))
+                    tile_mode = tile.mode
+                    tile.close()
 
-                    if tile.mode.endswith(IMAGE_OPACITY_MODE):
-                        tile_color_mode = tile.mode[:-1]
+                    if tile_mode.endswith(IMAGE_OPACITY_MODE):
+                        tile_color_mode = tile_mode[:-1]
                         full_image_opacity_mode = IMAGE_OPACITY_MODE
                     else:
-                        tile_color_mode = tile.mode
+                        tile_color_mode = tile_mode
 
                     if tile_color_mode not in IMAGE_COLOR_MODES:
-                        log.error("Resource %s tile %s has unexpected image mode %s" % (resource_name, tile_location, tile.mode))
+                        log.error("Resource %s tile %s has unexpected image mode %s" % (resource_name, tile_location, tile_mode))
                     elif IMAGE_COLOR_MODES.index(tile_color_mode) > IMAGE_COLOR_MODES.index(full_image_color_mode):
                         full_image_color_mode = tile_color_mode
                 else:
-                    tile = None
                     missing_tiles.append((x, y))
 
-                tile_images.append(tile)
                 tile_num += 1
 
         if missing_tiles:
@@ -420,6 +847,7 @@ def combine_image_tiles(
 
         full_image = Image.new(full_image_color_mode + full_image_opacity_mode, (resource_width, resource_height))
 
+        tile_num = 0
         for y, row in enumerate(yj_tiles):
             top_padding = 0 if y == 0 else tile_padding
             bottom_padding = min(tile_padding, resource_height - tile_height * (y + 1))
@@ -428,8 +856,11 @@ def combine_image_tiles(
                 left_padding = 0 if x == 0 else tile_padding
                 right_padding = min(tile_padding, resource_width - tile_width * (x + 1))
 
-                tile = tile_images.pop(0)
-                if tile is not None:
+                tile_raw_media = tiles_raw_media[tile_num]
+                tile_num += 1
+
+                if tile_raw_media is not None:
+                    tile = Image.open(io.BytesIO(tile_raw_media))
                     twidth, theight = tile.size
                     if twidth != tile_width + left_padding + right_padding or theight != tile_height + top_padding + bottom_padding:
                         log.error("Resource %s tile %d, %d size (%d, %d) does not have padding %d of expected size (%d, %d)" % (
@@ -437,17 +868,16 @@ def combine_image_tiles(
                         log.info("tile padding ltrb: %d, %d, %d, %d" % (left_padding, top_padding, right_padding, bottom_padding))
 
                     crop = (left_padding, top_padding, tile_width + left_padding, tile_height + top_padding)
-                    tile = tile.crop(crop)
-                    full_image.paste(tile, (x * tile_width, y * tile_height))
+                    cropped_tile = tile.crop(crop)
                     tile.close()
+                    full_image.paste(cropped_tile, (x * tile_width, y * tile_height))
+                    cropped_tile.close()
 
         if full_image.size != (resource_width, resource_height):
             log.error("Resource %s combined tiled image size is (%d, %d) but should be (%d, %d)" % (
                     resource_name, full_image.size[0], full_image.size[1], resource_width, resource_height))
 
-        if resource_format == "$285" and COMBINE_TILES_LOSSLESS:
-            resource_format = "$284"
-
+        resource_format = combined_tiles_format(resource_format)
         fmt = SYMBOL_FORMATS[resource_format]
 
         if fmt == "jpg":
@@ -471,36 +901,129 @@ def combine_image_tiles(
     return raw_media, resource_format
 
 
+def combined_tiles_format(resource_format):
+    if resource_format == "$285" and COMBINE_TILES_LOSSLESS:
+        return "$284"
+
+    return resource_format
+
+
 def optimize_jpeg_image_quality(jpeg_image, desired_size):
+    sample = jpeg_quality_sample(jpeg_image)
+
+    if sample is None:
+        encoded = {}
+
+        def encoded_size(quality):
+            encoded[quality] = encode_jpeg(jpeg_image, quality=quality)
+            return len(encoded[quality])
+
+        best_quality = search_jpeg_quality(encoded_size, desired_size)
+        return encoded[best_quality], best_quality
+
+    sample_sizes = {}
+
+    def predicted_size(quality):
+        if quality not in sample_sizes:
+            sample_sizes[quality] = len(encode_jpeg(sample, quality=quality))
+
+        return sample_sizes[quality] * scale
+
+    scale = (jpeg_image.size[0] * jpeg_image.size[1]) / (sample.size[0] * sample.size[1])
+    best_quality = best_raw_media = None
+
+    for i in range(MAX_JPEG_QUALITY_ENCODES):
+        quality = search_jpeg_quality(predicted_size, desired_size)
+        if quality == best_quality:
+            break
+
+        raw_media = encode_jpeg(jpeg_image, quality=quality)
+
+        if best_raw_media is None or abs(len(raw_media) - desired_size) < abs(len(best_raw_media) - desired_size):
+            best_quality = quality
+            best_raw_media = raw_media
+
+        scale = len(raw_media) / sample_sizes[quality]
+
+    sample.close()
+    return best_raw_media, best_quality
+
+
+def search_jpeg_quality(encoded_size, desired_size):
     min_quality = MIN_JPEG_QUALITY
     max_quality = MAX_JPEG_QUALITY
-    best_size_diff = best_quality = best_raw_media = None
+    best_size_diff = best_quality = None
 
     while max_quality >= min_quality:
         quality = (max_quality + min_quality) // 2
-        outfile = io.BytesIO()
-        jpeg_image.save(outfile, "JPEG", quality=quality, optimize=True)
-        raw_media = outfile.getvalue()
-        outfile.close()
-
-        size_diff = len(raw_media) - desired_size
+        size = encoded_size(quality)
+        size_diff = size - desired_size
 
         if best_size_diff is None or abs(size_diff) < abs(best_size_diff):
             best_size_diff = size_diff
             best_quality = quality
-            best_raw_media = raw_media
 
-        if len(raw_media) < desired_size:
+        if size < desired_size:
             min_quality = quality + 1
         else:
             max_quality = quality - 1
 
-    return best_raw_media, best_quality
+    return best_quality
+
+
+def jpeg_quality_sample(jpeg_image):
+    width, height = jpeg_image.size
+    band_count = height // (JPEG_QUALITY_SAMPLE_BAND_HEIGHT * JPEG_QUALITY_SAMPLE_INTERVAL)
+
+    if band_count < MIN_JPEG_QUALITY_SAMPLE_BANDS:
+        return None
+
+    sample = Image.new(jpeg_image.mode, (width, band_count * JPEG_QUALITY_SAMPLE_BAND_HEIGHT))
+    band_spacing = height // band_count
+
+    for i in range(band_count):
+        top = i * band_spacing + (band_spacing - JPEG_QUALITY_SAMPLE_BAND_HEIGHT) // 2
+        band = jpeg_image.crop((0, top, width, top + JPEG_QUALITY_SAMPLE_BAND_HEIGHT))
+        sample.paste(band, (0, i * JPEG_QUALITY_SAMPLE_BAND_HEIGHT))
+        band.close()
+
+    return sample
+
+
+def encode_jpeg(image, **kwargs):
+    outfile = io.BytesIO()
+    image.save(outfile, "JPEG", optimize=True, **kwargs)
+    raw_media = outfile.getvalue()
+    outfile.close()
+    return raw_media
+
+
+pdf_reader_cache = threading.local()
+jpegtran_exe = []
+
+
+def cached_pdf_reader(pdf_data):
+    readers = getattr(pdf_reader_cache, "readers", None)
+    if readers is None:
+        readers = pdf_reader_cache.readers = collections.OrderedDict()
+
+    cache_entry = readers.pop(id(pdf_data), None)
+    if cache_entry is None or cache_entry[0] is not pdf_data:
+        cache_entry = (pdf_data, pypdf.PdfReader(io.BytesIO(pdf_data)))
+
+    readers[id(pdf_data)] = cache_entry
+    while len(readers) > MAX_CACHED_PDF_READERS:
+        readers.popitem(last=False)
+
+    return cache_entry[1]
+
+
+def flush_pdf_reader_cache():
+    pdf_reader_cache.readers = None
 
 
 def get_pdf_page_size(pdf_data, resource_name, page_num):
-    raw_media_file = io.BytesIO(pdf_data)
-    pdf = pypdf.PdfReader(raw_media_file)
+    pdf = cached_pdf_reader(pdf_data)
     page = pdf.pages[page_num - 1]
 
     if page.user_unit != 1:
@@ -514,8 +1037,7 @@ def get_pdf_page_size(pdf_data, resource_name, page_num):
 
 
 def show_pdf_page_boxes(pdf_data, resource_name, page_num):
-    raw_media_file = io.BytesIO(pdf_data)
-    pdf = pypdf.PdfReader(raw_media_file)
+    pdf = cached_pdf_reader(pdf_data)
     page = pdf.pages[page_num - 1]
 
     def box_repr(box):
@@ -553,7 +1075,15 @@ def crop_image(raw_media, resource_name, resource_width, resource_height, margin
 
         cropped_img = img.crop((crop_left, crop_top, crop_right, crop_bottom))
 
-        if img.format == "JPEG":
+        if img.format == "JPEG" and getattr(img, "quantization", None):
+            subsampling = JpegImagePlugin.get_sampling(img)
+            if subsampling == -1:
+                cropped_raw_media = encode_jpeg(cropped_img, qtables=img.quantization)
+            else:
+                cropped_raw_media = encode_jpeg(cropped_img, qtables=img.quantization, subsampling=subsampling)
+
+            cropped_img.close()
+        elif img.format == "JPEG":
             cropped_raw_media = optimize_jpeg_image_quality(cropped_img, len(raw_media) * 0.6)[0]
         else:
             cropped_file = io.BytesIO()
@@ -567,6 +1097,78 @@ def crop_image(raw_media, resource_name, resource_width, resource_height, margin
     return cropped_raw_media
 
 
+def split_jpeg_image_lossless(raw_media):
+    jpegtran = available_jpegtran_path()
+    if jpegtran is None:
+        return None
+
+    with disable_debug_log():
+        img = Image.open(io.BytesIO(raw_media))
+        if img.format != "JPEG" or not getattr(img, "layer", None):
+            img.close()
+            return None
+
+        width, height = img.size
+        mcu_width = 8 * max(layer[1] for layer in img.layer)
+        img.close()
+
+    split = int(round(width / (2 * mcu_width))) * mcu_width
+    if split <= 0 or split >= width or abs(split - width // 2) > MAX_LOSSLESS_SPLIT_SHIFT:
+        return None
+
+    try:
+        left_raw_media = crop_jpeg_lossless(jpegtran, raw_media, split, height, 0, 0)
+        right_raw_media = crop_jpeg_lossless(jpegtran, raw_media, width - split, height, split, 0)
+    except (FileNotFoundError, PermissionError) as e:
+        jpegtran_unavailable(jpegtran, repr(e))
+        return None
+    except Exception as e:
+        log.warning("Lossless JPEG split failed: %s" % repr(e))
+        return None
+
+    return left_raw_media, right_raw_media, split
+
+
+def available_jpegtran_path():
+    if not jpegtran_exe:
+        jpegtran = jpegtran_path()
+        if jpegtran is not None and shutil.which(jpegtran) is None:
+            jpegtran_unavailable(jpegtran, "not found")
+        else:
+            jpegtran_exe.append(jpegtran)
+
+    return jpegtran_exe[0]
+
+
+def jpegtran_unavailable(jpegtran, reason):
+    log.warning("Lossless JPEG split disabled, jpegtran unavailable at %s: %s" % (jpegtran, reason))
+    jpegtran_exe[:] = [None]
+
+
+def jpegtran_path():
+    if calibre_numeric_version is None:
+        return None
+
+    try:
+        from calibre.utils.img import get_exe_path
+        return get_exe_path("jpegtran")
+    except Exception:
+        return None
+
+
+def crop_jpeg_lossless(jpegtran, raw_media, width, height, left, top):
+    process = subprocess.Popen(
+        [jpegtran, "-copy", "none", "-optimize", "-crop", "%dx%d+%d+%d" % (width, height, left, top)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0))
+    cropped_raw_media, errors = process.communicate(raw_media)
+
+    if process.returncode != 0 or not cropped_raw_media.startswith(b"\xff\xd8"):
+        raise Exception("jpegtran error code %d: %s" % (process.returncode, errors.decode("utf-8", "replace").strip()))
+
+    return cropped_raw_media
+
+
 def jpeg_type(data, fmt="jpg"):
 
     if fmt not in ["jpg", "jpeg"]:
@@ -647,3 +1249,11 @@ def image_size(data):
         cover_im.close()
 
     return (width, height)
+
+
+def image_header_size(data, resource_format=None):
+    if resource_format == "$548" or image_file_ext(data) == ".jxr":
+        jxr = JXRContainer(data)
+        return (jxr.image_width, jxr.image_height)
+
+    return image_size(data)
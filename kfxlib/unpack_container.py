@@ -1,6 +1,7 @@
 from __future__ import (unicode_literals, division, absolute_import, print_function)
 
 import io
+import os
 import posixpath
 import zipfile
 
@@ -57,7 +58,7 @@ class ZipUnpackContainer(YJContainer):
                             ftype=("$418" if fid in fonts else "$417"), fid=fid,
                             value=IonBLOB(zf.read(info))))
 
-    def serialize(self):
+    def serialize(self, outfile=None):
         desired_extension = {}
         for fragment in self.fragments.get_all("$164"):
             location = fragment.value.get("$165", "")
@@ -83,31 +84,40 @@ class ZipUnpackContainer(YJContainer):
                         for tile_location in tile_row:
                             desired_extension[tile_location] = extension
 
-        zfile = io.BytesIO()
+        zfile = io.BytesIO() if outfile is None else outfile
 
-        with zipfile.ZipFile(zfile, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        try:
+            with zipfile.ZipFile(zfile, "w", compression=zipfile.ZIP_DEFLATED) as zf:
 
-            zf.writestr("book.ion", IonTextContainer(
-                    self.symtab, fragments=self.fragments.filtered(omit_resources=True)).serialize())
+                zf.writestr("book.ion", IonTextContainer(
+                        self.symtab, fragments=self.fragments.filtered(omit_resources=True)).serialize())
 
-            for ftype in ["$417", "$418"]:
-                for fragment in self.fragments.get_all(ftype):
-                    fn = fragment.fid.tostring()
+                for ftype in ["$417", "$418"]:
+                    for fragment in self.fragments.get_all(ftype):
+                        fn = fragment.fid.tostring()
 
-                    if not posixpath.splitext(fn)[1]:
-                        if ftype == "$417":
-                            if fn in desired_extension:
-                                fn += self.ADDED_EXT_FLAG_CHAR + desired_extension[fn]
+                        if not posixpath.splitext(fn)[1]:
+                            if ftype == "$417":
+                                if fn in desired_extension:
+                                    fn += self.ADDED_EXT_FLAG_CHAR + desired_extension[fn]
+                                else:
+                                    extension = image_file_ext(fragment.value)
+                                    if extension:
+                                        fn += self.ADDED_EXT_FLAG_CHAR + extension
                             else:
-                                extension = image_file_ext(fragment.value)
+                                extension = font_file_ext(fragment.value)
                                 if extension:
                                     fn += self.ADDED_EXT_FLAG_CHAR + extension
-                        else:
-                            extension = font_file_ext(fragment.value)
-                            if extension:
-                                fn += self.ADDED_EXT_FLAG_CHAR + extension
 
-                    zf.writestr(fn, bytes(fragment.value))
+                        zf.writestr(fn, fragment.value)
+        except Exception:
+            if outfile is not None and os.path.isfile(outfile):
+                os.remove(outfile)
+
+            raise
+
+        if outfile is not None:
+            return None
 
         data = zfile.getvalue()
         zfile.close()
@@ -544,6 +544,9 @@ class KFXDRMError(ValueError):
     pass
 
 
+MAX_CACHED_ZIP_MEMBERS = 8
+
+
 @functools.total_ordering
 class DataFile(object):
     def __init__(self, name_or_stream, data=None, parent=None):
@@ -553,7 +556,7 @@ class DataFile(object):
         if isinstance(name_or_stream, str):
             self.stream = None
             self.relname = name_or_stream
-            self.is_real_file = data is None
+            self.is_real_file = data is None and parent is None
         else:
             self.stream = name_or_stream
             self.relname = self.stream.name if hasattr(self.stream, "name") else "stream"
@@ -561,6 +564,8 @@ class DataFile(object):
 
         self.data = data
         self.parent = parent
+        self.zip_file = None
+        self.member_datafiles = collections.OrderedDict()
 
         self.name = self.relname
         self.ext = os.path.splitext(self.relname)[1].lower()
@@ -571,11 +576,23 @@ class DataFile(object):
                 self.stream.seek(0)
                 self.data = self.stream.read()
                 self.stream.seek(0)
+            elif self.parent is not None:
+                self.data = self.parent.shared_ZipFile().read(self.relname)
             else:
                 self.data = file_read_binary(self.name)
 
         return self.data
 
+    def open(self):
+        if self.data is None:
+            if self.is_real_file:
+                return io.open(windows_long_path_fix(self.name), "rb")
+
+            if self.parent is not None:
+                return self.parent.shared_ZipFile().open(self.relname)
+
+        return io.BytesIO(self.get_data())
+
     def is_zipfile(self):
         return self.ext in [".azk", ".kfx-zip", ".kpf", ".zip"] or self.get_data().startswith(ZIP_SIGNATURE)
 
@@ -585,6 +602,31 @@ class DataFile(object):
 
         return zipfile.ZipFile(io.BytesIO(self.get_data()), "r")
 
+    def shared_ZipFile(self):
+        if self.zip_file is None:
+            self.zip_file = self.as_ZipFile()
+
+        return self.zip_file
+
+    def member_datafile(self, relname):
+        datafile = self.member_datafiles.pop(relname, None)
+        if datafile is None:
+            self.shared_ZipFile().getinfo(relname)
+            datafile = DataFile(relname, parent=self)
+
+        self.member_datafiles[relname] = datafile
+        while len(self.member_datafiles) > MAX_CACHED_ZIP_MEMBERS:
+            self.member_datafiles.popitem(last=False)
+
+        return datafile
+
+    def close(self):
+        if self.zip_file is not None:
+            self.zip_file.close()
+            self.zip_file = None
+
+        self.member_datafiles.clear()
+
     def relative_datafile(self, relname):
 
         if self.is_real_file:
@@ -603,8 +645,7 @@ class DataFile(object):
             if dirname:
                 relname = posixpath.join(dirname, relname)
 
-            with self.parent.as_ZipFile() as zf:
-                return DataFile(relname, zf.read(relname), self.parent)
+            return self.parent.member_datafile(relname)
 
         else:
             raise Exception("Cannot locate file relative to unknown parent: %s" % relname)
@@ -723,6 +764,25 @@ else:
         return s[start:stop]
 
 
+class PhaseTimer(object):
+    def __init__(self, description):
+        self.description = description
+        self.phases = []
+        self.start_time = time.process_time()
+
+    def end(self, phase):
+        now = time.process_time()
+        self.phases.append((phase, now - self.start_time))
+        self.start_time = now
+
+    def total(self):
+        return sum(duration for phase, duration in self.phases)
+
+    def report(self):
+        log.info("%s CPU time %0.3f sec: %s" % (self.description, self.total(), ", ".join(
+                "%s %0.3f sec" % phase_duration for phase_duration in self.phases)))
+
+
 class Serializer(object):
     def __init__(self):
         self.buffers = []
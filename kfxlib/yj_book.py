@@ -10,10 +10,11 @@ from .kfx_container import (KfxContainer, MAX_KFX_CONTAINER_SIZE)
 from .kpf_book import KpfBook
 from .kpf_container import KpfContainer
 from .message_logging import log
+from .resources import (flush_pdf_reader_cache, report_transcode_cache)
 from .unpack_container import (IonTextContainer, JsonContentContainer, ZipUnpackContainer)
 from .utilities import (
-        DataFile, file_read_utf8, flush_unicode_cache, bytes_to_separated_hex, KFXDRMError,
-        temp_file_cleanup, ZIP_SIGNATURE)
+        DataFile, file_read_utf8, flush_unicode_cache, bytes_to_separated_hex, json_deserialize, json_serialize, KFXDRMError,
+        PhaseTimer, temp_file_cleanup, windows_long_path_fix, ZIP_SIGNATURE)
 from .yj_container import YJFragmentList
 from .yj_metadata import BookMetadata
 from .yj_position_location import BookPosLoc
@@ -25,6 +26,27 @@ __license__ = "GPL v3"
 __copyright__ = "2016-2024, John Howell <jhowell@acm.org>"
 
 
+REPORT_VALIDATION_TIMING = False
+
+VALIDATION_FULL = "full"
+VALIDATION_FAST = "fast"
+VALIDATION_OFF = "off"
+VALIDATION_LEVELS = [VALIDATION_FULL, VALIDATION_FAST, VALIDATION_OFF]
+
+CONTAINER_HEADER_SIZE = 0x3c + 8
+
+KFX_MANIFEST_FILENAME = "kfx-manifest.json"
+
+
+def create_kfx_manifest(filepaths):
+    files = []
+    for filepath in filepaths:
+        stat = os.stat(windows_long_path_fix(filepath))
+        files.append({"path": os.path.abspath(filepath), "size": stat.st_size, "mtime": stat.st_mtime})
+
+    return json_serialize({"files": files}).encode("utf-8")
+
+
 class YJ_Book(BookStructure, BookPosLoc, BookMetadata, KpfBook):
     def __init__(self, file, credentials=[], is_netfs=False, symbol_catalog_filename=None):
         self.datafile = DataFile(file)
@@ -73,6 +95,9 @@ class YJ_Book(BookStructure, BookPosLoc, BookMetadata, KpfBook):
             self.symtab.report()
 
         flush_unicode_cache()
+        flush_pdf_reader_cache()
+        report_transcode_cache()
+        self.datafile.close()
         temp_file_cleanup()
 
     def convert_to_single_kfx(self):
@@ -106,10 +131,11 @@ class YJ_Book(BookStructure, BookPosLoc, BookMetadata, KpfBook):
         self.final_actions()
         return result
 
-    def convert_to_cbz(self, split_landscape_comic_images=False):
+    def convert_to_cbz(self, split_landscape_comic_images=False, output_filename=None):
         from .yj_to_image_book import KFX_IMAGE_BOOK
         self.decode_book()
-        result = KFX_IMAGE_BOOK(self).convert_book_to_cbz(split_landscape_comic_images)
+        result = KFX_IMAGE_BOOK(self).convert_book_to_cbz(
+                split_landscape_comic_images, None if output_filename is None else windows_long_path_fix(output_filename))
         self.final_actions()
         return result
 
@@ -122,29 +148,32 @@ class YJ_Book(BookStructure, BookPosLoc, BookMetadata, KpfBook):
 
     def get_metadata(self):
 
-        self.locate_book_datafiles()
+        try:
+            self.locate_book_datafiles()
 
-        yj_datafile_containers = []
-        for datafile in self.container_datafiles:
-            try:
-                container = self.get_container(datafile, ignore_drm=True)
-                if container is not None:
-                    container.deserialize(ignore_drm=True)
-                    yj_datafile_containers.append((datafile, container))
+            yj_datafile_containers = []
+            for datafile in self.container_datafiles:
+                try:
+                    container = self.get_container(datafile, ignore_drm=True)
+                    if container is not None:
+                        container.deserialize(ignore_drm=True)
+                        yj_datafile_containers.append((datafile, container))
 
-            except Exception as e:
-                log.warning("Failed to extract content from %s: %s" % (datafile.name, repr(e)))
+                except Exception as e:
+                    log.warning("Failed to extract content from %s: %s" % (datafile.name, repr(e)))
 
-        for datafile, container in yj_datafile_containers:
-            try:
-                self.fragments.extend(container.get_fragments())
+            for datafile, container in yj_datafile_containers:
+                try:
+                    self.fragments.extend(container.get_fragments())
 
-            except Exception as e:
-                log.warning("Failed to extract content from %s: %s" % (datafile.name, repr(e)))
-                continue
+                except Exception as e:
+                    log.warning("Failed to extract content from %s: %s" % (datafile.name, repr(e)))
+                    continue
 
-            if self.has_metadata() and self.has_cover_data():
-                break
+                if self.has_metadata() and self.has_cover_data():
+                    break
+        finally:
+            self.datafile.close()
 
         if not self.has_metadata():
             raise Exception("Failed to locate a KFX container with metadata")
@@ -187,9 +216,10 @@ class YJ_Book(BookStructure, BookPosLoc, BookMetadata, KpfBook):
         self.final_actions(do_symtab_report=False)
         return result
 
-    def convert_to_zip_unpack(self):
+    def convert_to_zip_unpack(self, output_filename=None):
         self.decode_book()
-        result = ZipUnpackContainer(self.symtab, fragments=self.fragments).serialize()
+        result = ZipUnpackContainer(self.symtab, fragments=self.fragments).serialize(
+                None if output_filename is None else windows_long_path_fix(output_filename))
         self.final_actions()
         return result
 
@@ -199,28 +229,44 @@ class YJ_Book(BookStructure, BookPosLoc, BookMetadata, KpfBook):
         self.final_actions()
         return result
 
-    def decode_book(self, set_metadata=None, set_approximate_pages=None, pure=False, retain_yj_locals=False):
+    def decode_book(self, set_metadata=None, set_approximate_pages=None, pure=False, retain_yj_locals=False,
+                    validation=VALIDATION_FULL):
         if self.fragments:
             if set_metadata is not None or set_approximate_pages is not None or retain_yj_locals:
                 raise Exception("Attempt to change metadata after book has already been decoded")
             return
 
-        self.locate_book_datafiles()
+        if validation not in VALIDATION_LEVELS:
+            raise Exception("Unknown validation level: %s" % validation)
 
-        for datafile in self.container_datafiles:
-            log.info("Processing container: %s" % datafile.name)
-            container = self.get_container(datafile)
-            container.deserialize()
-            self.yj_containers.append(container)
+        phase_timer = PhaseTimer("Book decode (validation %s)" % validation)
+
+        try:
+            self.locate_book_datafiles()
 
-        for container in self.yj_containers:
-            self.fragments.extend(container.get_fragments())
+            for datafile in self.container_datafiles:
+                log.info("Processing container: %s" % datafile.name)
+                container = self.get_container(datafile)
+                container.deserialize()
+                self.yj_containers.append(container)
+
+            for container in self.yj_containers:
+                self.fragments.extend(container.get_fragments())
+        finally:
+            self.datafile.close()
+
+        phase_timer.end("load")
 
         if self.is_kpf_prepub:
             self.fix_kpf_prepub_book(not pure, retain_yj_locals)
+            phase_timer.end("kpf fixup")
 
-        if True:
+        if validation == VALIDATION_FULL:
             self.check_consistency()
+            phase_timer.end("consistency")
+        elif validation == VALIDATION_FAST:
+            self.check_book_completeness()
+            phase_timer.end("completeness")
 
         if not pure:
             if set_metadata is not None:
@@ -233,17 +279,30 @@ class YJ_Book(BookStructure, BookPosLoc, BookMetadata, KpfBook):
                     traceback.print_exc()
                     log.error("Exception creating approximate page numbers: %s" % repr(e))
 
-        try:
-            self.report_features_and_metadata(unknown_only=False)
-        except Exception as e:
-            traceback.print_exc()
-            log.error("Exception checking book features and metadata: %s" % repr(e))
+            phase_timer.end("metadata")
+
+        if validation == VALIDATION_FULL:
+            try:
+                self.report_features_and_metadata(unknown_only=False)
+            except Exception as e:
+                traceback.print_exc()
+                log.error("Exception checking book features and metadata: %s" % repr(e))
+
+            phase_timer.end("features")
 
-        self.check_fragment_usage(rebuild=not pure, ignore_extra=False)
-        self.check_symbol_table(rebuild=not pure, ignore_unused=self.is_scribe_notebook)
+        if validation == VALIDATION_FULL or not pure:
+            self.check_fragment_usage(rebuild=not pure, ignore_extra=validation != VALIDATION_FULL)
+            phase_timer.end("fragment usage")
+
+            self.check_symbol_table(
+                    rebuild=not pure, ignore_unused=self.is_scribe_notebook or validation != VALIDATION_FULL)
+            phase_timer.end("symbol table")
 
         self.final_actions()
 
+        if REPORT_VALIDATION_TIMING:
+            phase_timer.report()
+
     def locate_book_datafiles(self):
         self.container_datafiles = []
 
@@ -261,13 +320,16 @@ class YJ_Book(BookStructure, BookPosLoc, BookMetadata, KpfBook):
 
         elif self.datafile.ext in [".kfx-zip", ".zip"]:
             with self.datafile.as_ZipFile() as zf:
-                for info in zf.infolist():
-                    if posixpath.basename(info.filename).lower() in ["book.ion", "book.kdf"]:
-                        self.container_datafiles.append(self.datafile)
-                        break
+                if KFX_MANIFEST_FILENAME in zf.namelist():
+                    self.locate_files_from_manifest(zf.read(KFX_MANIFEST_FILENAME))
                 else:
                     for info in zf.infolist():
-                        self.check_located_file(info.filename, zf.read(info), self.datafile)
+                        if posixpath.basename(info.filename).lower() in ["book.ion", "book.kdf"]:
+                            self.container_datafiles.append(self.datafile)
+                            break
+                    else:
+                        for info in zf.infolist():
+                            self.check_located_file(info.filename, parent=self.datafile)
 
         else:
             raise Exception("Unknown main file type. Must be azw8, ion, kfx, kfx-zip, kpf, or zip.")
@@ -283,6 +345,20 @@ class YJ_Book(BookStructure, BookPosLoc, BookMetadata, KpfBook):
                 if (not match) or match == fn:
                     self.check_located_file(os.path.join(dirpath, fn))
 
+    def locate_files_from_manifest(self, manifest_data):
+        for entry in json_deserialize(manifest_data)["files"]:
+            filepath = entry["path"]
+
+            try:
+                stat = os.stat(windows_long_path_fix(filepath))
+            except OSError:
+                stat = None
+
+            if stat is None or stat.st_size != entry["size"] or stat.st_mtime != entry["mtime"]:
+                raise Exception("File referenced by %s is missing or has changed: %s" % (self.datafile.name, filepath))
+
+            self.check_located_file(filepath)
+
     def check_located_file(self, name, data=None, parent=None):
         basename = posixpath.basename(name.replace("\\", "/")).lower()
         ext = os.path.splitext(basename)[1]
@@ -296,7 +372,8 @@ class YJ_Book(BookStructure, BookPosLoc, BookMetadata, KpfBook):
         if datafile.ext == ".ion":
             return IonTextContainer(self.symtab, datafile)
 
-        data = datafile.get_data()
+        with datafile.open() as f:
+            data = f.read(CONTAINER_HEADER_SIZE)
 
         if data.startswith(ZIP_SIGNATURE):
             with datafile.as_ZipFile() as zf:
@@ -278,6 +278,16 @@ class YJFragmentList(IonList):
         self.yj_dirty = True
         self.yj_ftype_index = collections.defaultdict(list)
         self.yj_fragment_index = collections.defaultdict(list)
+        self.yj_walk_cache = {}
+
+    def yj_clear_walk_cache(self):
+        self.yj_walk_cache = {}
+
+    def yj_retain_walk_cache(self, fragments):
+        retained = set(id(f) for f in self)
+        for fragment_id, cache_entry in fragments.yj_walk_cache.items():
+            if fragment_id in retained:
+                self.yj_walk_cache[fragment_id] = cache_entry
 
     def yj_rebuild_index(self):
         self.yj_ftype_index.clear()
@@ -336,6 +346,7 @@ class YJFragmentList(IonList):
 
         IonList.append(self, value)
         self.yj_dirty = True
+        self.yj_clear_walk_cache()
 
     def extend(self, values):
         if not isinstance(values, YJFragmentList):
@@ -343,6 +354,7 @@ class YJFragmentList(IonList):
 
         IonList.extend(self, values)
         self.yj_dirty = True
+        self.yj_clear_walk_cache()
 
     def remove(self, value):
         if not self.discard(value):
@@ -356,6 +368,7 @@ class YJFragmentList(IonList):
             if f is value:
                 self.pop(i)
                 self.yj_dirty = True
+                self.yj_clear_walk_cache()
                 return True
 
         return False
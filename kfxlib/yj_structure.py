@@ -189,6 +189,15 @@ class SYM_TYPE:
     UNKNOWN = "unknown"
 
 
+class FragmentWalk(object):
+    def __init__(self):
+        self.mandatory_frag_refs = set()
+        self.optional_frag_refs = set()
+        self.eid_defs = set()
+        self.eid_refs = set()
+        self.symbols = set()
+
+
 class BookStructure(object):
 
     def check_consistency(self):
@@ -275,9 +284,7 @@ class BookStructure(object):
             actual_container_ids = set(containers.keys())
             missing_container_ids = cem_container_ids - actual_container_ids
             if missing_container_ids:
-                raise Exception("Book is incomplete. All of the KFX container files that make up the book must be combined "
-                                "into a KFX-ZIP file for successful conversion. (Missing containers %s)" %
-                                list_symbols(list(missing_container_ids)))
+                raise incomplete_book_error("Missing containers %s" % list_symbols(list(missing_container_ids)))
                 log.error("Entity map references missing containers: %s" % list_symbols(missing_container_ids))
 
             extra_ids = actual_container_ids - cem_container_ids
@@ -288,49 +295,8 @@ class BookStructure(object):
             if extra_ids:
                 log.error("Found containers missing from entity map: %s" % list_symbols(extra_ids))
 
-        required_ftypes = REQUIRED_BOOK_FRAGMENT_TYPES.copy()
-        allowed_ftypes = ALLOWED_BOOK_FRAGMENT_TYPES.copy()
         present_ftypes = self.fragments.ftypes()
-
-        if self.is_dictionary or self.is_scribe_notebook or self.is_kpf_prepub:
-            required_ftypes.remove("$419")
-            required_ftypes.remove("$265")
-            required_ftypes.remove("$264")
-        else:
-            required_ftypes.remove("$611")
-
-            if self.get_feature_value("kfxgen.positionMaps", namespace="format_capabilities") != 2:
-                allowed_ftypes.remove("$609")
-                allowed_ftypes.remove("$621")
-
-        if not self.is_kpf_prepub:
-            allowed_ftypes.remove("$610")
-
-        if self.is_dictionary or self.is_scribe_notebook or self.is_magazine or self.is_print_replica:
-            required_ftypes.remove("$550")
-
-            if not self.is_dictionary:
-                allowed_ftypes.discard("$621")
-
-        if not self.is_magazine:
-            allowed_ftypes.remove("$267")
-            allowed_ftypes.remove("$390")
-
-        if self.is_kfx_v1:
-            required_ftypes.remove("$538")
-            required_ftypes.discard("$265")
-
-        if self.is_scribe_notebook:
-            required_ftypes.remove("$389")
-            required_ftypes.remove("$611")
-            allowed_ftypes.add("$611")
-
-        allowed_ftypes.update(required_ftypes)
-
-        if "$490" in present_ftypes:
-            required_ftypes.remove("$258")
-        elif "$258" in present_ftypes:
-            required_ftypes.remove("$490")
+        required_ftypes, allowed_ftypes = self.book_fragment_types(present_ftypes)
 
         missing_ftypes = required_ftypes - present_ftypes
         if missing_ftypes:
@@ -339,8 +305,7 @@ class BookStructure(object):
             if missing_ftypes == {"$389"}:
                 log.warning("Book incomplete. Missing %s" % missing_ft)
             else:
-                raise Exception("Book is incomplete. All of the KFX container files that make up the book must be combined "
-                                "into a KFX-ZIP file for successful conversion. (Missing fragments %s)" % missing_ft)
+                raise incomplete_book_error("Missing fragments %s" % missing_ft)
                 log.error("Book incomplete. Missing %s" % missing_ft)
 
         extra_ftypes = present_ftypes - allowed_ftypes
@@ -705,6 +670,71 @@ class BookStructure(object):
                             if not is_known_kcb_data(kcb_category, kcb_key, kcb_value):
                                 log.warning("Unknown KCB data: %s/%s=%s" % (kcb_category, kcb_key, kcb_value))
 
+    def book_fragment_types(self, present_ftypes):
+        required_ftypes = REQUIRED_BOOK_FRAGMENT_TYPES.copy()
+        allowed_ftypes = ALLOWED_BOOK_FRAGMENT_TYPES.copy()
+
+        if self.is_dictionary or self.is_scribe_notebook or self.is_kpf_prepub:
+            required_ftypes.remove("$419")
+            required_ftypes.remove("$265")
+            required_ftypes.remove("$264")
+        else:
+            required_ftypes.remove("$611")
+
+            if self.get_feature_value("kfxgen.positionMaps", namespace="format_capabilities") != 2:
+                allowed_ftypes.remove("$609")
+                allowed_ftypes.remove("$621")
+
+        if not self.is_kpf_prepub:
+            allowed_ftypes.remove("$610")
+
+        if self.is_dictionary or self.is_scribe_notebook or self.is_magazine or self.is_print_replica:
+            required_ftypes.remove("$550")
+
+            if not self.is_dictionary:
+                allowed_ftypes.discard("$621")
+
+        if not self.is_magazine:
+            allowed_ftypes.remove("$267")
+            allowed_ftypes.remove("$390")
+
+        if self.is_kfx_v1:
+            required_ftypes.remove("$538")
+            required_ftypes.discard("$265")
+
+        if self.is_scribe_notebook:
+            required_ftypes.remove("$389")
+            required_ftypes.remove("$611")
+            allowed_ftypes.add("$611")
+
+        allowed_ftypes.update(required_ftypes)
+
+        if "$490" in present_ftypes:
+            required_ftypes.remove("$258")
+        elif "$258" in present_ftypes:
+            required_ftypes.remove("$490")
+
+        return (required_ftypes, allowed_ftypes)
+
+    def check_book_completeness(self):
+        container_ids = set()
+        for fragment in self.fragments.get_all("$270"):
+            if "$409" in fragment.value:
+                container_ids.add(fragment.value["$409"])
+
+        container_entity_map = self.fragments.get("$419", first=True)
+        if container_entity_map is not None:
+            missing_container_ids = set(
+                cem_container_info["$155"] for cem_container_info in container_entity_map.value["$252"]) - container_ids
+            if missing_container_ids:
+                raise incomplete_book_error("Missing containers %s" % list_symbols(list(missing_container_ids)))
+
+        present_ftypes = self.fragments.ftypes()
+        required_ftypes = self.book_fragment_types(present_ftypes)[0]
+        missing_ftypes = required_ftypes - present_ftypes
+        if missing_ftypes and missing_ftypes != {"$389"}:
+            raise incomplete_book_error("Missing fragments %s" % list_symbols(missing_ftypes))
+
     def extract_fragment_id_from_value(self, ftype, value):
         if ion_type(value) is IonStruct and ftype in FRAGMENT_ID_KEYS:
             for id_key in FRAGMENT_ID_KEYS[ftype]:
@@ -746,6 +776,8 @@ class BookStructure(object):
         eid_defs = set()
         eid_refs = set()
 
+        self.fragments.yj_clear_walk_cache()
+
         for ftype in CONTAINER_FRAGMENT_TYPES:
             visited.add(YJFragmentKey(ftype=ftype))
             visited.add(YJFragmentKey(ftype=ftype, fid=ftype))
@@ -756,15 +788,14 @@ class BookStructure(object):
 
             for fragment in self.fragments:
                 if fragment in next_visits:
-                    mandatory_refs = set()
-                    optional_refs = set()
-
-                    self.walk_fragment(fragment, mandatory_refs, optional_refs, eid_defs, eid_refs)
+                    fragment_walk = self.analyze_fragment(fragment)
+                    eid_defs |= fragment_walk.eid_defs
+                    eid_refs |= fragment_walk.eid_refs
 
                     visited.add(fragment)
-                    mandatory_references[fragment] = mandatory_refs
-                    optional_references[fragment] = optional_refs
-                    discovered |= mandatory_refs | optional_refs
+                    mandatory_references[fragment] = fragment_walk.mandatory_frag_refs
+                    optional_references[fragment] = fragment_walk.optional_frag_refs
+                    discovered |= fragment_walk.mandatory_frag_refs | fragment_walk.optional_frag_refs
 
             missing |= (next_visits - visited)
 
@@ -851,7 +882,9 @@ class BookStructure(object):
                     IS("$588"), kfxgen_package_version or "",
                     IS("version"), version or KfxContainer.VERSION)))
 
+            old_fragments = self.fragments
             self.fragments = YJFragmentList(sorted(referenced_fragments))
+            self.fragments.yj_retain_walk_cache(old_fragments)
 
             if not (self.is_dictionary or self.is_scribe_notebook):
                 self.rebuild_container_entity_map(container_id, self.determine_entity_dependencies(mandatory_references, optional_references))
@@ -860,14 +893,34 @@ class BookStructure(object):
         return "CR!%s" % "".join(random.choice(string.ascii_uppercase + string.digits) for _ in range(28))
 
     def walk_fragment(self, fragment, mandatory_frag_refs, optional_frag_refs, eid_defs, eid_refs):
-
-        def walk(data, container=None, container_parent=None, top_level=False):
+        fragment_walk = self.analyze_fragment(fragment, cached=False)
+        mandatory_frag_refs |= fragment_walk.mandatory_frag_refs
+        optional_frag_refs |= fragment_walk.optional_frag_refs
+        eid_defs |= fragment_walk.eid_defs
+        eid_refs |= fragment_walk.eid_refs
+
+    def analyze_fragment(self, fragment, cached=True):
+        if cached:
+            cache_entry = self.fragments.yj_walk_cache.get(id(fragment))
+            if cache_entry is not None and cache_entry[0] is fragment:
+                return cache_entry[1]
+
+        fragment_walk = FragmentWalk()
+        mandatory_frag_refs = fragment_walk.mandatory_frag_refs
+        optional_frag_refs = fragment_walk.optional_frag_refs
+        eid_defs = fragment_walk.eid_defs
+        eid_refs = fragment_walk.eid_refs
+        symbols = fragment_walk.symbols
+
+        def walk(data, container=None, container_parent=None, top_level=False, from_string=False):
             data_type = ion_type(data)
 
             if container is None:
                 container = fragment.ftype
 
             if data_type is IonAnnotation:
+                symbols.update(data.annotations)
+
                 if not top_level:
                     if len(data.annotations) != 1:
                         self.log_error_once("Found multiple annotations in %s of %s fragment" % (container, fragment.ftype))
@@ -885,17 +938,24 @@ class BookStructure(object):
 
             elif data_type is IonStruct:
                 for fk, fv in data.items():
+                    symbols.add(fk)
                     walk(fv, fk, container)
 
             elif data_type is IonSExp:
+                if data:
+                    self.find_symbol_references(data[0], symbols)
+
                 for fc in data[1:]:
                     walk(fc, data[0], container)
 
             elif data_type is IonString:
                 if container in ["$165", "$636"]:
-                    walk(IS(data), container, container_parent)
+                    walk(IS(data), container, container_parent, from_string=True)
 
             elif data_type is IonSymbol:
+                if not from_string:
+                    symbols.add(data)
+
                 if container == "$155" or (self.is_kpf_prepub and container == "$174"):
                     eid_defs.add(data)
 
@@ -954,6 +1014,11 @@ class BookStructure(object):
             log.info("Exception processing fragment: %s" % repr(fragment))
             raise
 
+        if cached:
+            self.fragments.yj_walk_cache[id(fragment)] = (fragment, fragment_walk)
+
+        return fragment_walk
+
     def determine_entity_dependencies(self, mandatory_references, optional_references):
         deep_references = {}
 
@@ -1042,6 +1107,7 @@ class BookStructure(object):
         else:
             log.error("Omitting container_entity_map due to lack of content")
 
+        new_fragments.yj_retain_walk_cache(self.fragments)
         self.fragments = new_fragments
 
     def classify_symbol(self, name):
@@ -1106,7 +1172,11 @@ class BookStructure(object):
         original_symbols = set()
         for fragment in self.fragments:
             if fragment.ftype not in CONTAINER_FRAGMENT_TYPES:
-                self.find_symbol_references(fragment, used_symbols)
+                cache_entry = self.fragments.yj_walk_cache.get(id(fragment))
+                if cache_entry is not None and cache_entry[0] is fragment:
+                    used_symbols |= cache_entry[1].symbols
+                else:
+                    self.find_symbol_references(fragment, used_symbols)
 
             if fragment.ftype == "$ion_symbol_table":
                 original_symbols |= set(fragment.value.get("symbols", []))
@@ -1314,5 +1384,10 @@ class BookStructure(object):
             self.reported_errors.add(msg)
 
 
+def incomplete_book_error(reason):
+    return Exception("Book is incomplete. All of the KFX container files that make up the book must be combined "
+                     "into a KFX-ZIP file for successful conversion. (%s)" % reason)
+
+
 def numstr(x):
     return "%g" % x
@@ -12,7 +12,8 @@ import re
 from .epub_output import (EPUB_NS_URI, EPUB_TYPE, IDX_ENTRY, MATH, qname, SVG, XML_LANG, XML_NS_URI, value_str)
 from .ion import (ion_type, IonBool, IonDecimal, IonFloat, IonInt, IonList, IonString, IonStruct, IonSymbol, isstring)
 from .message_logging import log
-from .utilities import (get_url_filename, list_symbols, natural_sort_key, remove_duplicates, type_name, urlabspath, urlrelpath)
+from .utilities import (
+        get_url_filename, list_symbols, natural_sort_key, PhaseTimer, remove_duplicates, type_name, urlabspath, urlrelpath)
 
 
 __license__ = "GPL v3"
@@ -25,6 +26,7 @@ EMIT_OEB_PAGE_PROPS = False
 DETECT_LAYOUT_ENHANCER = False
 FIX_PT_TO_PX = True
 REMOVE_EMPTY_NAMED_CLASSES = True
+REPORT_STYLE_TIMING = False
 
 REVERSE_INHERITANCE = True
 REVERSE_INHERITANCE_FRACTION = 0.8
@@ -1076,6 +1078,7 @@ class KFX_EPUB_Properties(object):
         self.fixed_font_names = {}
         self.font_faces = []
         self.incorrect_font_quoting = set()
+        self.attached_styles = None
 
         for name in GENERIC_FONT_NAMES:
             self.fix_font_name(name, add=True, generic=True)
@@ -1396,9 +1399,12 @@ class KFX_EPUB_Properties(object):
             return
 
         self.css_rules = {}
+        phase_timer = PhaseTimer("style")
 
         self.non_heritable_default_properties = self.Style(NON_HERITABLE_DEFAULT_PROPERTIES)
 
+        self.attach_styles()
+
         for book_part in self.book_parts:
             self.last_kfx_heading_level = "1"
             heritable_default_properties = self.Style(HERITABLE_DEFAULTS_FILTERED)
@@ -1406,13 +1412,20 @@ class KFX_EPUB_Properties(object):
             if lang:
                 heritable_default_properties.update(self.Style({"-kfx-attrib-xml-lang": lang}), replace=True)
 
-            self.simplify_styles(book_part.body(), book_part, heritable_default_properties)
+            body = book_part.body()
+            self.simplify_styles(body, book_part, heritable_default_properties)
+            self.add_composite_and_equivalent_styles(body, book_part)
 
-            self.add_composite_and_equivalent_styles(book_part.body(), book_part)
+        self.detach_styles()
+        phase_timer.end("simplification")
 
         self.create_conditional_page_templates()
+        phase_timer.end("conditional page templates")
 
         style_counts = collections.defaultdict(lambda: 0)
+        styled_elems = []
+
+        self.attach_styles()
 
         for book_part in self.book_parts:
             body = book_part.body()
@@ -1427,6 +1440,7 @@ class KFX_EPUB_Properties(object):
                 if "style" in e.attrib:
 
                     style = self.get_style(e)
+                    styled_elems.append((book_part, e))
                     style_modified = False
 
                     style_attribs = style.partition(name_prefix="-kfx-attrib-", remove_prefix=True)
@@ -1508,8 +1522,12 @@ class KFX_EPUB_Properties(object):
                         style.pop("-kfx-layout-hints", None)
                         self.set_style(e, style)
 
-                if "style" in e.attrib:
-                    style_counts[e.get("style")] += 1
+                    if style:
+                        style_counts[style.tostring()] += 1
+
+        attached_styles = self.attached_styles
+        self.attached_styles = None
+        phase_timer.end("attribute and bidi fixup")
 
         sorted_style_data = []
         known_class_name_count = collections.defaultdict(lambda: 0)
@@ -1561,26 +1579,31 @@ class KFX_EPUB_Properties(object):
             classes[class_name] = style
             style_class_names[style_str] = class_name
 
-        for book_part in self.book_parts:
-            body = book_part.body()
-            for e in body.iter("*"):
-                style_str = e.get("style", "")
-                if style_str in style_class_names:
-                    class_name = style_class_names[style_str]
-                    class_style = classes[class_name]
-
-                    if ((KEEP_STYLES_INLINE or book_part.is_fxl) and
-                            class_name not in selector_classes and
-                            "-kfx-media-query" not in class_style):
-                        e.set("style", class_style.tostring())
-                        self.inventory_style(class_style)
-                    else:
-                        self.add_class(e, class_name, before=True)
-                        referenced_classes.add(class_name)
-                        e.attrib.pop("style", None)
+        phase_timer.end("class naming")
+
+        for book_part, e in styled_elems:
+            style = attached_styles.get(e)
+            style_str = style.tostring() if style is not None else ""
+            if style_str in style_class_names:
+                class_name = style_class_names[style_str]
+                class_style = classes[class_name]
+
+                if ((KEEP_STYLES_INLINE or book_part.is_fxl) and
+                        class_name not in selector_classes and
+                        "-kfx-media-query" not in class_style):
+                    e.set("style", class_style.tostring())
+                    self.inventory_style(class_style)
+                else:
+                    self.add_class(e, class_name, before=True)
+                    referenced_classes.add(class_name)
+                    e.attrib.pop("style", None)
 
-                elif style_str:
-                    log.warning("Style has no class name: %s" % style_str)
+            elif style_str:
+                log.warning("Style has no class name: %s" % style_str)
+                e.set("style", style_str)
+
+            else:
+                e.attrib.pop("style", None)
 
         for class_name, class_style in classes.items():
             if class_name in referenced_classes:
@@ -1596,6 +1619,11 @@ class KFX_EPUB_Properties(object):
             for class_style in mq_classes.values():
                 self.inventory_style(class_style)
 
+        phase_timer.end("class assignment")
+
+        if REPORT_STYLE_TIMING:
+            phase_timer.report()
+
     def inventory_style(self, style):
         reported = set()
         for key, value in style.items():
@@ -1920,6 +1948,9 @@ class KFX_EPUB_Properties(object):
 
                     sty.update(new_heritable_sty, replace=True)
 
+        for child in elem.findall("*"):
+            self.add_composite_and_equivalent_styles(child, book_part)
+
         inherited_properties.update(self.non_heritable_default_properties)
 
         if elem.tag == "div" and not (self.fixed_layout or self.illustrated_layout or self.has_conditional_content):
@@ -2018,9 +2049,6 @@ class KFX_EPUB_Properties(object):
 
         self.set_style(elem, sty)
 
-        for child in elem.findall("*"):
-            self.add_composite_and_equivalent_styles(child, book_part)
-
     def fix_and_quote_font_family_list(self, value):
         return ",".join(remove_duplicates(
             [self.quote_font_name(name) for name in self.split_and_fix_font_family_list(value)]))
@@ -2210,13 +2238,37 @@ class KFX_EPUB_Properties(object):
 
             elem.set("class", " ".join(classes))
 
+    def attach_styles(self):
+        # keep styles as Style objects instead of attribute strings until detach_styles is called
+        self.attached_styles = {}
+
+    def detach_styles(self):
+        attached_styles, self.attached_styles = self.attached_styles, None
+
+        for elem, style in attached_styles.items():
+            self.set_style(elem, style)
+
     def get_style(self, elem, remove=False):
+        if self.attached_styles is not None:
+            if elem not in self.attached_styles:
+                self.attached_styles[elem] = self.Style(elem.get("style", ""))
+
+            if remove:
+                elem.attrib.pop("style", None)
+                return self.attached_styles.pop(elem)
+
+            return self.attached_styles[elem].copy()
+
         return self.Style(elem.attrib.pop("style", "") if remove else elem.get("style", ""))
 
     def set_style(self, elem, new_style):
         if type(new_style) is not Style:
             raise Exception("set_style: type %s" % type_name(new_style))
 
+        if self.attached_styles is not None:
+            self.attached_styles[elem] = new_style.copy()
+            return
+
         style_str = new_style.tostring()
         if style_str:
             elem.set("style", style_str)
@@ -2228,7 +2280,10 @@ class KFX_EPUB_Properties(object):
             raise Exception("add_style: type %s" % type_name(new_style))
 
         if new_style:
-            orig_style_str = elem.get("style", "")
+            if self.attached_styles is not None and elem in self.attached_styles:
+                orig_style_str = self.attached_styles[elem].tostring()
+            else:
+                orig_style_str = elem.get("style", "")
 
             if orig_style_str:
                 new_style = self.Style(orig_style_str).update(new_style, replace)
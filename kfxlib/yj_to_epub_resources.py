@@ -6,8 +6,8 @@ import urllib.parse
 
 from .message_logging import log
 from .resources import (
-    EXTS_OF_MIMETYPE, combine_image_tiles, convert_jxr_to_jpeg_or_png, convert_pdf_to_jpeg, font_file_ext,
-    image_file_ext, RESOURCE_TYPE_OF_EXT, SYMBOL_FORMATS)
+    EXTS_OF_MIMETYPE, combine_image_tiles, combined_tiles_format, convert_jxr_to_jpeg_or_png, convert_pdf_to_jpeg,
+    font_file_ext, image_file_ext, image_header_size, RESOURCE_TYPE_OF_EXT, SYMBOL_FORMATS)
 from .utilities import (root_filename, urlrelpath)
 
 
@@ -37,6 +37,9 @@ class KFX_EPUB_Resources(object):
     def get_external_resource(self, resource_name, ignore_variants=False):
         resource_obj = self.resource_cache.get(resource_name)
         if resource_obj is not None:
+            if not ignore_variants:
+                self.decode_external_resource(resource_obj)
+
             return resource_obj
 
         resource = self.get_fragment(ftype="$164", fid=resource_name)
@@ -52,6 +55,7 @@ class KFX_EPUB_Resources(object):
         resource_height = resource.pop("$423", None) or fixed_height
         resource_width = resource.pop("$422", None) or fixed_width
 
+        tiles = None
         if "$636" in resource:
             yj_tiles = resource.pop("$636")
             tile_height = resource.pop("$638")
@@ -64,9 +68,14 @@ class KFX_EPUB_Resources(object):
                 for tile_location in row:
                     tiles_raw_media.append(self.locate_raw_media(tile_location))
 
-            raw_media, resource_format = combine_image_tiles(
-                resource_name, resource_height, resource_width, resource_format, tile_height, tile_width, tile_padding,
-                yj_tiles, tiles_raw_media, ignore_variants)
+            if any(tile_raw_media is None for tile_raw_media in tiles_raw_media):
+                raw_media, resource_format = combine_image_tiles(
+                    resource_name, resource_height, resource_width, resource_format, tile_height, tile_width, tile_padding,
+                    yj_tiles, tiles_raw_media, ignore_variants)
+            else:
+                tiles = (resource_name, resource_height, resource_width, resource_format, tile_height, tile_width, tile_padding,
+                         yj_tiles, tiles_raw_media, ignore_variants)
+                raw_media, resource_format = None, combined_tiles_format(resource_format)
         else:
             location = resource.pop("$165")
             search_path = resource.pop("$166", location)
@@ -75,9 +84,17 @@ class KFX_EPUB_Resources(object):
 
             raw_media = self.locate_raw_media(location)
 
-        if ignore_variants and raw_media is None:
+        has_media = raw_media is not None or tiles is not None
+
+        if ignore_variants and not has_media:
             return None
 
+        if ignore_variants and (resource_width is None or resource_height is None) and raw_media is not None:
+            try:
+                resource_width, resource_height = image_header_size(raw_media, resource_format)
+            except Exception:
+                pass
+
         if resource_format in SYMBOL_FORMATS:
             extension = "." + SYMBOL_FORMATS[resource_format]
         else:
@@ -121,13 +138,11 @@ class KFX_EPUB_Resources(object):
         if "$214" in resource:
             self.process_external_resource(resource.pop("$214"), save=False)
 
-        if FIX_JPEG_XR and (resource_format == "$548") and (raw_media is not None):
-            raw_media, resource_format = convert_jxr_to_jpeg_or_png(raw_media, location_fn)
-            extension = "." + SYMBOL_FORMATS[resource_format]
-            location_fn = location_fn.rpartition(".")[0] + extension
+        transcode_jxr = FIX_JPEG_XR and (resource_format == "$548") and has_media
 
         suffix = ""
-        if resource_format == "$565" and raw_media is not None:
+        pdf_page_num = None
+        if resource_format == "$565" and has_media:
             if "$564" in resource:
                 page_num = resource.pop("$564") + 1
                 suffix = "-page%d" % page_num
@@ -146,40 +161,70 @@ class KFX_EPUB_Resources(object):
                     repr((margin_left, margin_top, margin_right, margin_bottom))))
 
             if FIX_PDF:
-                try:
-                    jpeg_data = convert_pdf_to_jpeg(raw_media, page_num, reported_errors=self.reported_pdf_errors)
-                except Exception as e:
-                    log.error("Exception during conversion of PDF \"%s\" page %d to JPEG: %s" % (location_fn, page_num, repr(e)))
-                else:
-                    raw_media = jpeg_data
-                    extension = ".jpg"
-                    location_fn = location_fn.rpartition(".")[0] + extension
-
-        filename = self.resource_location_filename(location_fn, suffix, self.IMAGE_FILEPATH)
+                pdf_page_num = page_num
 
+        selected_variant = None
         if not ignore_variants:
             for rr in resource.pop("$635", []):
                 variant = self.get_external_resource(rr, ignore_variants=True)
 
-                if (USE_HIGHEST_RESOLUTION_IMAGE_VARIANT and variant is not None and
-                        variant.width > resource_width and variant.height > resource_height):
-                    if self.DEBUG:
-                        log.info("Replacing image %s (%dx%d) with variant %s (%dx%d)" % (
-                                filename, resource_width, resource_height, variant.filename, variant.width, variant.height))
+                if (USE_HIGHEST_RESOLUTION_IMAGE_VARIANT and variant is not None and variant.width is not None and
+                        variant.height is not None and variant.width > resource_width and variant.height > resource_height):
+                    selected_variant, resource_width, resource_height = variant, variant.width, variant.height
 
-                    raw_media, filename, resource_width, resource_height = variant.raw_media, variant.filename, variant.width, variant.height
-
-        if "$564" in resource:
-            filename += "#page=%d" % (resource.pop("$564") + 1)
+        page_fragment = ("#page=%d" % (resource.pop("$564") + 1)) if "$564" in resource else ""
 
         self.check_empty(resource, "resource %s" % resource_name)
 
         resource_obj = self.resource_cache[resource_name] = Obj(
-                    raw_media=raw_media, filename=filename, extension=extension, format=resource_format, mime=mime, location=location,
-                    width=resource_width, height=resource_height, referred_resources=referred_resources, manifest_entry=None)
+                    raw_media=raw_media, filename=None, extension=extension, format=resource_format, mime=mime,
+                    location=location, width=resource_width, height=resource_height, referred_resources=referred_resources,
+                    manifest_entry=None,
+                    pending=(tiles, transcode_jxr, pdf_page_num, location_fn, suffix, page_fragment))
+
+        if selected_variant is not None:
+            self.decode_external_resource(selected_variant)
+
+            if self.DEBUG:
+                log.info("Replacing image %s (%dx%d) with variant %s (%dx%d)" % (
+                        location_fn, resource_obj.width, resource_obj.height, selected_variant.filename,
+                        selected_variant.width, selected_variant.height))
+
+            resource_obj.raw_media, resource_obj.filename = selected_variant.raw_media, selected_variant.filename + page_fragment
+            resource_obj.extension, resource_obj.format = selected_variant.extension, selected_variant.format
+            resource_obj.pending = None
+        elif not ignore_variants:
+            self.decode_external_resource(resource_obj)
 
         return resource_obj
 
+    def decode_external_resource(self, resource_obj):
+        if resource_obj.pending is None:
+            return
+
+        tiles, transcode_jxr, pdf_page_num, location_fn, suffix, page_fragment = resource_obj.pending
+        resource_obj.pending = None
+
+        if tiles is not None:
+            resource_obj.raw_media, resource_obj.format = combine_image_tiles(*tiles)
+
+        if transcode_jxr:
+            resource_obj.raw_media, resource_obj.format = convert_jxr_to_jpeg_or_png(resource_obj.raw_media, location_fn)
+            resource_obj.extension = "." + SYMBOL_FORMATS[resource_obj.format]
+            location_fn = location_fn.rpartition(".")[0] + resource_obj.extension
+
+        if pdf_page_num is not None:
+            try:
+                jpeg_data = convert_pdf_to_jpeg(resource_obj.raw_media, pdf_page_num, reported_errors=self.reported_pdf_errors)
+            except Exception as e:
+                log.error("Exception during conversion of PDF \"%s\" page %d to JPEG: %s" % (location_fn, pdf_page_num, repr(e)))
+            else:
+                resource_obj.raw_media = jpeg_data
+                resource_obj.extension = ".jpg"
+                location_fn = location_fn.rpartition(".")[0] + resource_obj.extension
+
+        resource_obj.filename = self.resource_location_filename(location_fn, suffix, self.IMAGE_FILEPATH) + page_fragment
+
     def process_external_resource(self, resource_name, save=True, process_referred=False, save_referred=False,
                                   is_plugin=False, is_referred=False):
 
@@ -4,13 +4,16 @@ from __future__ import (unicode_literals, division, absolute_import, print_funct
 import collections
 import datetime
 import io
+import os
 import re
+import time
 import zipfile
 
 from .message_logging import log
 from .resources import (
-    combine_image_tiles, convert_image_to_pdf, convert_jxr_to_jpeg_or_png, convert_pdf_to_jpeg,
-    crop_image, ImageResource, PdfImageResource, pypdf, SYMBOL_FORMATS)
+    add_image_to_pdf, cached_pdf_reader, combine_image_tiles, convert_image_to_pdf, convert_jxr_to_jpeg_or_png,
+    convert_pdf_pages_to_jpeg, crop_image, image_header_size, ImageResource, split_jpeg_image_lossless, PdfImageResource, pypdf,
+    SYMBOL_FORMATS)
 from .utilities import (json_serialize_compact, list_counts)
 from .yj_to_epub import KFX_EPUB
 
@@ -19,13 +22,14 @@ __copyright__ = "2016-2024, John Howell <jhowell@acm.org>"
 
 USE_HIGHEST_RESOLUTION_IMAGE_VARIANT = True
 DEBUG_VARIANTS = False
+STORED_CBZ_FORMATS = {"$284", "$285", "$286"}
 
 
 class KFX_IMAGE_BOOK(object):
     def __init__(self, book):
         self.book = book
 
-    def convert_book_to_cbz(self, split_landscape_comic_images):
+    def convert_book_to_cbz(self, split_landscape_comic_images, outfile=None):
         kfx_epub = KFX_EPUB(self.book, metadata_only=True)
         is_rtl = kfx_epub.page_progression_direction == "rtl"
         ordered_images = self.get_ordered_images(split_landscape_comic_images, kfx_epub.is_comic, is_rtl)[0]
@@ -56,7 +60,7 @@ class KFX_IMAGE_BOOK(object):
 
         cbz_metadata = {"ComicBookInfo/1.0": comic_book_info} if comic_book_info else None
 
-        return combine_images_into_cbz(ordered_images, cbz_metadata)
+        return combine_images_into_cbz(ordered_images, cbz_metadata, outfile)
 
     def convert_book_to_pdf(self, split_landscape_comic_images):
         kfx_epub = KFX_EPUB(self.book, metadata_only=True)
@@ -118,17 +122,29 @@ class KFX_IMAGE_BOOK(object):
                     split_image_count += 1
 
                     new_width = image_resource.width // 2
-                    left_image = crop_image(
-                        image_resource.raw_media, image_resource.location, image_resource.width, image_resource.height,
-                        0, new_width, 0, 0)
+                    split_images = None
+                    if image_resource.format == "$285":
+                        split_images = split_jpeg_image_lossless(image_resource.raw_media)
+
+                    if split_images is not None:
+                        left_image, right_image, split = split_images
+                        left_width, right_width = split, image_resource.width - split
+                    else:
+                        left_image = crop_image(
+                            image_resource.raw_media, image_resource.location, image_resource.width, image_resource.height,
+                            0, new_width, 0, 0)
+                        right_image = crop_image(
+                            image_resource.raw_media, image_resource.location, image_resource.width, image_resource.height,
+                            new_width, 0, 0, 0)
+                        left_width = right_width = new_width
+
                     left = ImageResource(
-                        image_resource.format, suffix_location(image_resource.location, "-L"), left_image, image_resource.height, new_width)
+                        image_resource.format, suffix_location(image_resource.location, "-L"), left_image,
+                        image_resource.height, left_width)
 
-                    right_image = crop_image(
-                        image_resource.raw_media, image_resource.location, image_resource.width, image_resource.height,
-                        new_width, 0, 0, 0)
                     right = ImageResource(
-                        image_resource.format, suffix_location(image_resource.location, "-R"), right_image, image_resource.height, new_width)
+                        image_resource.format, suffix_location(image_resource.location, "-R"), right_image,
+                        image_resource.height, right_width)
 
                     if not is_rtl:
                         ordered_images.append(left)
@@ -163,6 +179,28 @@ class KFX_IMAGE_BOOK(object):
         resource_width = resource.get("$422", None) or resource.get("$66", None)
         page_index = resource.get("$564", 0)
 
+        if resource_format != "$565" and not ignore_variants and USE_HIGHEST_RESOLUTION_IMAGE_VARIANT:
+            selected_variant = None
+            selected_width, selected_height = resource_width, resource_height
+            for rr in resource.get("$635", []):
+                variant_size = self.probe_resource_image(rr)
+
+                if (variant_size is not None and variant_size[0] > selected_width and variant_size[1] > selected_height):
+                    selected_variant = rr
+                    selected_width, selected_height = variant_size
+
+            if selected_variant is not None:
+                variant = self.get_resource_image(selected_variant, ignore_variants=True)
+
+                if variant is not None:
+                    if DEBUG_VARIANTS:
+                        log.info("Replacing image %s (%dx%d) with variant %s (%dx%d)" % (
+                                resource_name, resource_width, resource_height, variant.location, variant.width, variant.height))
+
+                    return variant
+
+                log.warning("Image variant %s of %s is unusable, using the base image" % (selected_variant, resource_name))
+
         if "$636" in resource:
             yj_tiles = resource.get("$636")
             tile_height = resource.get("$638")
@@ -188,19 +226,6 @@ class KFX_IMAGE_BOOK(object):
             else:
                 raw_media = None
 
-        if resource_format != "$565" and not ignore_variants:
-            for rr in resource.get("$635", []):
-                variant = self.get_resource_image(rr, ignore_variants=True)
-
-                if (USE_HIGHEST_RESOLUTION_IMAGE_VARIANT and variant is not None and
-                        variant.width > resource_width and variant.height > resource_height):
-                    if DEBUG_VARIANTS:
-                        log.info("Replacing image %s (%dx%d) with variant %s (%dx%d)" % (
-                                location, resource_width, resource_height, variant.location, variant.width, variant.height))
-
-                    location, resource_format, raw_media, resource_width, resource_height = (
-                        variant.location, variant.format, variant.raw_media, variant.width, variant.height)
-
         if raw_media is None:
             return None
 
@@ -209,6 +234,37 @@ class KFX_IMAGE_BOOK(object):
 
         return ImageResource(resource_format, location, raw_media, resource_height, resource_width)
 
+    def probe_resource_image(self, resource_name):
+        fragment = self.book.fragments.get(ftype="$164", fid=resource_name)
+        if fragment is None:
+            return None
+
+        resource = fragment.value
+        resource_height = resource.get("$423", None) or resource.get("$67", None)
+        resource_width = resource.get("$422", None) or resource.get("$66", None)
+
+        if "$636" in resource:
+            for row in resource.get("$636"):
+                for tile_location in row:
+                    if self.book.fragments.get(ftype="$417", fid=tile_location) is None:
+                        return None
+        else:
+            location = resource.get("$165")
+            raw_media = None if location is None else self.book.fragments.get(ftype="$417", fid=location)
+            if raw_media is None:
+                return None
+
+            if resource_width is None or resource_height is None:
+                try:
+                    resource_width, resource_height = image_header_size(raw_media.value, resource.get("$161"))
+                except Exception:
+                    return None
+
+        if resource_width is None or resource_height is None:
+            return None
+
+        return (resource_width, resource_height)
+
 
 def combine_images_into_pdf(ordered_images, metadata=None, is_rtl=False, outline=None):
     if len(ordered_images) == 0:
@@ -223,13 +279,14 @@ def combine_images_into_pdf(ordered_images, metadata=None, is_rtl=False, outline
             if combined_pdf_images and combined_pdf_images[-1].format == "$565" and combined_pdf_images[-1].location == image_resource.location:
                 combined_pdf_images[-1].page_nums.extend(image_resource.page_nums)
             else:
-                pdf = pypdf.PdfReader(io.BytesIO(image_resource.raw_media))
+                pdf = cached_pdf_reader(image_resource.raw_media)
                 image_resource.total_pages = len(pdf.pages)
                 combined_pdf_images.append(image_resource)
         else:
-            combined_pdf_images.append(convert_image_to_pdf(image_resource))
+            combined_pdf_images.append(image_resource)
 
-    if len(combined_pdf_images) == 1 and combined_pdf_images[0].entire_resource_used():
+    if (len(combined_pdf_images) == 1 and combined_pdf_images[0].format == "$565" and
+            combined_pdf_images[0].entire_resource_used()):
         combined = False
         pdf_data = combined_pdf_images[0].raw_media
 
@@ -237,7 +294,7 @@ def combine_images_into_pdf(ordered_images, metadata=None, is_rtl=False, outline
             return pdf_data
 
         try:
-            writer = pypdf.PdfWriter(clone_from=io.BytesIO(pdf_data))
+            writer = pypdf.PdfWriter(clone_from=cached_pdf_reader(pdf_data))
         except Exception as e:
             log.error("pypdf PdfWriter error in clone_from %s: %s" % (combined_pdf_images[0].location, repr(e)))
             return None
@@ -247,14 +304,17 @@ def combine_images_into_pdf(ordered_images, metadata=None, is_rtl=False, outline
 
         for image_resource in combined_pdf_images:
             try:
-                if image_resource.entire_resource_used():
-                    writer.append(fileobj=io.BytesIO(image_resource.raw_media))
+                if image_resource.format != "$565":
+                    if not add_image_to_pdf(writer, image_resource):
+                        writer.append(fileobj=io.BytesIO(convert_image_to_pdf(image_resource).raw_media))
+                elif image_resource.entire_resource_used():
+                    writer.append(fileobj=cached_pdf_reader(image_resource.raw_media))
                 else:
                     log.warning("Using PDF %s pages %s of %d" % (
                         image_resource.location, repr(image_resource.page_nums), image_resource.total_pages))
 
                     for page_range in image_resource.page_number_ranges():
-                        writer.append(fileobj=io.BytesIO(image_resource.raw_media), pages=page_range)
+                        writer.append(fileobj=cached_pdf_reader(image_resource.raw_media), pages=page_range)
             except Exception as e:
                 log.error("pypdf PdfWriter error appending %s: %s" % (image_resource.location, repr(e)))
                 return None
@@ -297,7 +357,7 @@ def add_pdf_outline(pdf_writer, outline_entries, parent=None):
             add_pdf_outline(pdf_writer, outline_entry.children, new_entry)
 
 
-def combine_images_into_cbz(ordered_images, metadata=None):
+def combine_images_into_cbz(ordered_images, metadata=None, outfile=None):
     if len(ordered_images) == 0:
         return None
 
@@ -309,8 +369,7 @@ def combine_images_into_cbz(ordered_images, metadata=None):
         if image_resource.format in {"$286", "$285", "$284"}:
             page_images.append(image_resource)
         elif image_resource.format == "$565":
-            for page_num in image_resource.page_nums:
-                image_data = convert_pdf_to_jpeg(image_resource.raw_media, page_num)
+            for page_num, image_data in convert_pdf_pages_to_jpeg(image_resource.raw_media, image_resource.page_nums):
                 page_images.append(ImageResource("$285", None, image_data))
         elif image_resource.format == "$548":
             image_data, fmt = convert_jxr_to_jpeg_or_png(image_resource.raw_media, image_resource.location)
@@ -318,25 +377,50 @@ def combine_images_into_cbz(ordered_images, metadata=None):
         else:
             raise Exception("Unexpected image format: %s" % image_resource.format)
 
-    cbz_file = io.BytesIO()
-
-    with zipfile.ZipFile(cbz_file, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-        for i, image_resource in enumerate(page_images):
-            zf.writestr("%04d.%s" % (i + 1, SYMBOL_FORMATS[image_resource.format]), image_resource.raw_media)
+    cbz_file = io.BytesIO() if outfile is None else outfile
+    stored_count = stored_size = deflated_count = deflated_saved = 0
+    deflate_time = 0.0
 
-        if metadata:
-            comment = json_serialize_compact(metadata).encode("utf-8")
-            if len(comment) <= 65535:
-                zf.comment = comment
-            else:
-                log.warning("Discarding CBZ metadata -- too long for ZIP comment")
+    try:
+        with zipfile.ZipFile(cbz_file, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for i, image_resource in enumerate(page_images):
+                filename = "%04d.%s" % (i + 1, SYMBOL_FORMATS[image_resource.format])
+
+                if image_resource.format in STORED_CBZ_FORMATS:
+                    zf.writestr(filename, image_resource.raw_media, compress_type=zipfile.ZIP_STORED)
+                    stored_count += 1
+                    stored_size += len(image_resource.raw_media)
+                else:
+                    start_time = time.time()
+                    zf.writestr(filename, image_resource.raw_media)
+                    deflate_time += time.time() - start_time
+                    deflated_count += 1
+                    deflated_saved += len(image_resource.raw_media) - zf.getinfo(filename).compress_size
+
+            if metadata:
+                comment = json_serialize_compact(metadata).encode("utf-8")
+                if len(comment) <= 65535:
+                    zf.comment = comment
+                else:
+                    log.warning("Discarding CBZ metadata -- too long for ZIP comment")
+    except Exception:
+        if outfile is not None and os.path.isfile(outfile):
+            os.remove(outfile)
 
-    cbz_data = cbz_file.getvalue()
-    cbz_file.close()
+        raise
 
     log.info("Combined %s resources into a %d page CBZ file" % (
         list_counts(image_resource_formats), len(ordered_images)))
 
+    log.info("CBZ stored %d images (%d bytes) and compressed %d images (%d bytes saved in %0.2f sec)" % (
+        stored_count, stored_size, deflated_count, deflated_saved, deflate_time))
+
+    if outfile is not None:
+        return None
+
+    cbz_data = cbz_file.getvalue()
+    cbz_file.close()
+
     return cbz_data
 
 
@@ -0,0 +1,87 @@
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+import unittest
+
+from kfxlib.ion import (ion_data_eq, IonBLOB, IonStruct, IS)
+from kfxlib.ion_symbol_table import LocalSymbolTable
+from kfxlib.kpf_container import KpfContainer
+from kfxlib.utilities import (DataFile, temp_file_cleanup)
+from kfxlib.yj_container import (YJFragment, YJFragmentKey, YJFragmentList)
+from kfxlib.yj_symbol_catalog import YJ_SYMBOLS
+
+
+class KpfTestBook(object):
+    is_netfs = False
+    is_dictionary = False
+    is_scribe_notebook = False
+    is_kpf_prepub = False
+
+    def __init__(self, symtab):
+        self.symtab = symtab
+
+    def create_local_symbol(self, name):
+        return self.symtab.create_local_symbol(name)
+
+
+def create_container():
+    symtab = LocalSymbolTable(YJ_SYMBOLS.name)
+    section_name = symtab.create_local_symbol("c0")
+    story_name = symtab.create_local_symbol("l1")
+    resource_name = symtab.create_local_symbol("rsrc2")
+
+    fragments = YJFragmentList()
+    fragments.append(YJFragment(symtab.create_import()))
+    fragments.append(YJFragment(ftype="$490", value=IonStruct(IS("$491"), [IonStruct(
+            IS("$495"), "kindle_title_metadata", IS("$258"), [IonStruct(IS("$492"), "title", IS("$307"), "Round Trip")])])))
+    fragments.append(YJFragment(ftype="$260", fid=section_name, value=IonStruct(
+            IS("$174"), section_name, IS("$141"), [IonStruct(IS("$155"), 3, IS("$176"), story_name)])))
+    fragments.append(YJFragment(ftype="$259", fid=story_name, value=IonStruct(
+            IS("$176"), story_name, IS("$146"), [IonStruct(IS("$155"), 4, IS("$145"), "text %d" % i) for i in range(5)])))
+    fragments.append(YJFragment(ftype="$417", fid=resource_name, value=IonBLOB(b"\x89PNG\r\n\x1a\nresource data")))
+    fragments.append(YJFragment(ftype="$593", value=[IonStruct(IS("$492"), "db.schema", IS("version"), 1)]))
+    fragments.append(YJFragment(ftype="$270", value=IonStruct(IS("$587"), "", IS("$588"), "", IS("$161"), "KPF")))
+
+    container = KpfContainer(symtab, fragments=fragments, book=KpfTestBook(symtab))
+    container.eid_symbol = {7: story_name}
+    return container
+
+
+def read_container(kdf_data):
+    symtab = LocalSymbolTable(YJ_SYMBOLS.name)
+    container = KpfContainer(symtab, DataFile("book.kdf", kdf_data), book=KpfTestBook(symtab))
+    container.deserialize()
+    return container
+
+
+class TestKpfContainerSerialize(unittest.TestCase):
+    def tearDown(self):
+        temp_file_cleanup()
+
+    def assertFragmentsEqual(self, expected, actual):
+        for fragment in expected:
+            if fragment.ftype == "$270":
+                continue
+
+            actual_fragment = actual.get(YJFragmentKey(annot=fragment.annotations))
+            self.assertIsNotNone(actual_fragment, repr(fragment))
+            self.assertTrue(ion_data_eq(fragment.value, actual_fragment.value), repr(fragment))
+
+        self.assertEqual(len(actual), len(expected))
+
+    def test_round_trip(self):
+        container = create_container()
+        read_back = read_container(container.serialize())
+
+        self.assertFragmentsEqual(container.fragments, read_back.fragments)
+        self.assertEqual(read_back.eid_symbol, {7: "l1"})
+        self.assertEqual(read_back.element_type, {"$490": "$490", "c0": "$260", "l1": "$259", "rsrc2": "$417"})
+
+        read_again = read_container(read_back.serialize())
+
+        self.assertFragmentsEqual(read_back.fragments, read_again.fragments)
+        self.assertEqual(read_again.eid_symbol, read_back.eid_symbol)
+        self.assertEqual(read_again.element_type, read_back.element_type)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from kfxlib import resources
+from kfxlib.resources import TranscodeCache
+
+
+class TestTranscodeCache(unittest.TestCase):
+    def setUp(self):
+        self.saved_settings = (
+            resources.MAX_TRANSCODE_CACHE_MEMORY, resources.TRANSCODE_CACHE_DIRECTORY, resources.MAX_TRANSCODE_CACHE_DISK,
+            resources.TRANSCODE_CACHE_VERSION)
+        resources.MAX_TRANSCODE_CACHE_MEMORY = 1000
+        resources.TRANSCODE_CACHE_DIRECTORY = None
+        self.cache = TranscodeCache()
+
+    def tearDown(self):
+        (resources.MAX_TRANSCODE_CACHE_MEMORY, resources.TRANSCODE_CACHE_DIRECTORY,
+            resources.MAX_TRANSCODE_CACHE_DISK, resources.TRANSCODE_CACHE_VERSION) = self.saved_settings
+
+    def test_key_depends_on_content_and_operation(self):
+        data = b"a" * 10
+
+        self.assertEqual(self.cache.key(data, "op"), self.cache.key(b"a" * 10, "op"))
+        self.assertNotEqual(self.cache.key(data, "op"), self.cache.key(data, "other"))
+        self.assertNotEqual(self.cache.key(data, "op"), self.cache.key(b"b" * 10, "op"))
+
+    def test_key_depends_on_cache_version(self):
+        data = b"a" * 10
+        key = self.cache.key(data, "op")
+
+        resources.TRANSCODE_CACHE_VERSION += 1
+        self.assertNotEqual(self.cache.key(data, "op"), key)
+        self.assertEqual(self.cache.digest_key(self.cache.digest(data), "op"), self.cache.key(data, "op"))
+
+    def test_memory_lru_eviction(self):
+        for name in ["a", "b", "c"]:
+            self.cache.put(name, name.encode("ascii") * 400)
+
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.get("b"), b"b" * 400)
+
+        self.cache.put("d", b"d" * 400)
+
+        self.assertIsNone(self.cache.get("c"))
+        self.assertEqual(self.cache.get("b"), b"b" * 400)
+        self.assertLessEqual(self.cache.memory_size, resources.MAX_TRANSCODE_CACHE_MEMORY)
+
+    def test_pinned_digest_inputs_count_against_memory(self):
+        data = b"x" * 400
+        self.cache.key(data, "op")
+        self.assertEqual(self.cache.memory_size, 400)
+
+        self.cache.put("a", b"a" * 400)
+        self.cache.put("b", b"b" * 400)
+
+        self.assertLessEqual(self.cache.memory_size, resources.MAX_TRANSCODE_CACHE_MEMORY)
+        self.assertEqual(len(self.cache.digests), 0)
+        self.assertEqual(self.cache.get("a"), b"a" * 400)
+
+        large_data = b"y" * 600
+        digest = self.cache.digest(large_data)
+        self.assertLessEqual(self.cache.memory_size, resources.MAX_TRANSCODE_CACHE_MEMORY)
+        self.assertIsNone(self.cache.digests[id(large_data)][0])
+        self.assertEqual(self.cache.digest(large_data), digest)
+
+        self.cache.report()
+        self.assertEqual(self.cache.memory_size, sum(len(value) for value in self.cache.entries.values()))
+
+    def test_hit_counters(self):
+        self.cache.put("a", b"a")
+        self.cache.get("a")
+        self.cache.get("a")
+        self.cache.get("b")
+
+        self.assertEqual((self.cache.hits, self.cache.disk_hits, self.cache.misses), (2, 0, 1))
+
+        self.cache.report()
+        self.assertEqual((self.cache.hits, self.cache.disk_hits, self.cache.misses), (0, 0, 0))
+
+    def test_disk_cache_and_eviction(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        resources.TRANSCODE_CACHE_DIRECTORY = directory
+        resources.MAX_TRANSCODE_CACHE_DISK = 1000
+
+        for i, name in enumerate(["a", "b", "c"]):
+            self.cache.put(name, name.encode("ascii") * 400)
+            filename = self.cache.disk_filename(name)
+            if os.path.isfile(filename):
+                os.utime(filename, (i, i))
+
+        sizes = [os.path.getsize(os.path.join(directory, fn)) for fn in os.listdir(directory)]
+        self.assertLessEqual(sum(sizes), resources.MAX_TRANSCODE_CACHE_DISK)
+
+        fresh_cache = TranscodeCache()
+        self.assertIsNone(fresh_cache.get("a"))
+        self.assertEqual(fresh_cache.get("c"), b"c" * 400)
+        self.assertEqual((fresh_cache.hits, fresh_cache.disk_hits, fresh_cache.misses), (0, 1, 1))
+
+        self.assertEqual(fresh_cache.get("c"), b"c" * 400)
+        self.assertEqual(fresh_cache.hits, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
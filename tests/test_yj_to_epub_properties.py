@@ -0,0 +1,49 @@
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+import unittest
+
+from lxml import etree
+
+from kfxlib.epub_output import (BookPart, EPUB_Output)
+from kfxlib.yj_to_epub import KFX_EPUB
+
+
+def create_converter():
+    converter = KFX_EPUB.__new__(KFX_EPUB)
+    for base in KFX_EPUB.__bases__:
+        if base is EPUB_Output:
+            base.__init__(converter, will_output=False)
+        else:
+            base.__init__(converter)
+
+    converter.book_has_illustrated_layout_conditional_page_template = False
+    return converter
+
+
+class TestFixupStylesAndClasses(unittest.TestCase):
+    def fixup(self, body):
+        converter = create_converter()
+        html = etree.fromstring("<html><head/><body>%s</body></html>" % body)
+        converter.book_parts = [BookPart("part0000.xhtml", 0, html)]
+        converter.fixup_styles_and_classes()
+        return converter, html.find("body")
+
+    def test_plain_styled_element_keeps_class(self):
+        converter, body = self.fixup('<div><p style="color: red">x</p><p>y</p></div>')
+        p = body.find("div/p")
+
+        self.assertIsNone(p.get("style"))
+        self.assertEqual(p.get("class"), "class-0")
+        self.assertEqual(converter.css_rules[".class-0"].tostring(), "color: red")
+
+    def test_unused_style_produces_no_class(self):
+        converter, body = self.fixup('<div><p style="color: red">x</p><p style="direction: rtl; unicode-bidi: embed">y</p></div>')
+        ps = body.findall("div/p")
+
+        self.assertEqual(ps[1].get("dir"), "rtl")
+        self.assertIsNone(ps[1].get("class"))
+        self.assertEqual(sorted(converter.css_rules.keys()), [".class-0"])
+
+
+if __name__ == "__main__":
+    unittest.main()